@@ -11,7 +11,7 @@ Image.MAX_IMAGE_PIXELS = None
 
 PATH_TO_WEIGHTS = f"{os.path.dirname(os.path.abspath(__file__))}/src/modelFiles/final_weights.h5"
 
-def segment_core(nucelus_img, overlap=80, threshold=20, increase_factor=1, grow_mask=True, grow_pixels=10, grow_method='Sequential'):
+def segment_core(nucelus_img, overlap=80, threshold=20, increase_factor=1, grow_mask=True, grow_pixels=10, grow_method='Sequential', grow_workers=1):
     assert type(nucelus_img) == TiffImagePlugin.TiffImageFile or type(nucelus_img) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(nucelus_img)}'
     # Converting PIL Image to np, and expanding dimensions
     nucleus_array = np.expand_dims(np.array(nucelus_img,dtype=np.uint8),axis=2)
@@ -34,10 +34,11 @@ def segment_core(nucelus_img, overlap=80, threshold=20, increase_factor=1, grow_
     nucleus_mask = stitched_mask.flatmasks
 
     # Return the Nucleus and Membrane Masks,
-    return Image.fromarray(nucleus_mask.astype(np.uint32)), grow_mask_with_pad(nucelus_mask=nucleus_mask, grow_pixels=grow_pixels, grow_method=grow_method)
+    return Image.fromarray(nucleus_mask.astype(np.uint32)), grow_mask_with_pad(nucelus_mask=nucleus_mask, grow_pixels=grow_pixels, grow_method=grow_method, grow_workers=grow_workers)
     
 
-def grow_mask_with_pad(nucelus_mask,grow_pixels=10, grow_method='Sequential'):
+def grow_mask_with_pad(nucelus_mask,grow_pixels=10, grow_method='Sequential', grow_workers=1):
+    # grow_method: 'Sequential', 'Standard' or 'Frontier' (every mask grown at once, split into tiles over grow_workers processes when > 1)
     # assert type(nucelus_img) == TiffImagePlugin.TiffImageFile or type(nucelus_img) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(nucelus_img)}'
     # Convert input to correct type if necceary
     if type(nucelus_mask) == TiffImagePlugin.TiffImageFile or type(nucelus_mask) == Image.Image:
@@ -49,7 +50,7 @@ def grow_mask_with_pad(nucelus_mask,grow_pixels=10, grow_method='Sequential'):
         
     nucelus_mask.compute_centroids()
     nucelus_mask.compute_boundbox()
-    nucelus_mask.grow_masks(growth=grow_pixels, method=grow_method)
+    nucelus_mask.grow_masks(growth=grow_pixels, method=grow_method, workers=grow_workers)
     
     membrane_mask = nucelus_mask.flatmasks
     # xPad = nucleus_array.shape[0] - membrane_mask.shape[0]
@@ -0,0 +1,113 @@
+# cvsparse.py
+# ---------------------------
+# Sparse representation of instance masks.  See class doc for details.
+
+import numpy as np
+
+class SparseMasks():
+    """
+    Instance masks stored as the list of pixels of each mask (compressed sparse rows: the pixels of mask ids[i] are
+    indices[indptr[i]:indptr[i + 1]], as indices into the flattened image in row major order).  Masks don't overlap,
+    each pixel belongs to at most one mask, and ids are unique and sorted.  Memory is proportional to the number of
+    mask pixels rather than height x width x number of masks, as for a stack of one boolean plane per mask.
+    """
+    def __init__(self, shape, ids, indptr, indices):
+        self.shape = tuple(shape)
+        self.ids = ids
+        self.indptr = indptr
+        self.indices = indices
+
+    @classmethod
+    def from_pixels(cls, shape, pixels, labels):
+        #groups (flat pixel index, label) pairs by label, pixels of each mask in row major order
+        order = np.lexsort((pixels, labels))
+        pixels, labels = pixels[order], labels[order]
+        ids, starts = np.unique(labels, return_index = True)
+        indptr = np.append(starts, len(labels)).astype(np.int64)
+        return cls(shape, ids, indptr, pixels.astype(np.int64))
+
+    @classmethod
+    def from_flat(cls, flat):
+        #from a label image, 0 is background
+        pixels = np.flatnonzero(flat)
+        return cls.from_pixels(flat.shape, pixels, np.ravel(flat)[pixels])
+
+    @classmethod
+    def from_instances(cls, stack):
+        #from a (height, width, n) stack of boolean masks (as the model detects them), mask i gets id i + 1.  Where
+        #masks overlap the pixel goes to the highest id, as np.max(np.arange(1, n + 1) * stack, axis=2) would give
+        height, width, _ = stack.shape
+        rows, cols, layers = np.nonzero(stack)
+        pixels = rows.astype(np.int64) * width + cols
+        #np.nonzero lists the layers of each pixel in increasing order, so the last entry of a pixel is its highest id
+        last = np.ones(len(pixels), dtype = bool)
+        last[:-1] = pixels[1:] != pixels[:-1]
+        return cls.from_pixels((height, width), pixels[last], layers[last].astype(np.int64) + 1)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def sizes(self):
+        return np.diff(self.indptr)
+
+    def labels(self):
+        #id of each entry of indices
+        return np.repeat(self.ids, self.sizes())
+
+    def flatten(self, dtype = np.uint32, out = None):
+        #label image, written into out (of self.shape) if given
+        if out is None:
+            out = np.zeros(self.shape, dtype = dtype)
+        np.put(out, self.indices, self.labels())
+        return out
+
+    def window(self, top, left, height, width, dtype = np.uint32):
+        #label image of just the (height, width) window at (top, left), 0 is background
+        out = np.zeros((height, width), dtype = dtype)
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        inside = (rows >= top) & (rows < top + height) & (cols >= left) & (cols < left + width)
+        out[rows[inside] - top, cols[inside] - left] = self.labels()[inside]
+        return out
+
+    def relabel(self, lut):
+        #maps the ids through the lookup table, masks mapped to 0 are removed and masks mapped to the same id merged
+        labels = lut[self.labels()]
+        keep = labels > 0
+        return SparseMasks.from_pixels(self.shape, self.indices[keep], labels[keep])
+
+    def select(self, keep):
+        #the masks for which keep (a boolean per mask) is set
+        counts = self.sizes()[keep]
+        return SparseMasks(self.shape, self.ids[keep], np.append(0, np.cumsum(counts)).astype(np.int64),
+                           self.indices[np.repeat(keep, self.sizes())])
+
+    def renumber(self, offset = 0):
+        #masks numbered consecutively from offset + 1, in order of id
+        return SparseMasks(self.shape, np.arange(offset + 1, offset + len(self) + 1, dtype = np.int64),
+                           self.indptr, self.indices)
+
+    def bbox(self):
+        #(min_row, min_col, max_row, max_col) of each mask, max exclusive (as skimage's regionprops bbox)
+        if not len(self):
+            return np.zeros((0, 4), dtype = np.int64)
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        starts = self.indptr[:-1]
+        #pixels are in row major order, so the first and last pixels of a mask are on its first and last rows
+        return np.stack([rows[starts], np.minimum.reduceat(cols, starts),
+                         rows[self.indptr[1:] - 1] + 1, np.maximum.reduceat(cols, starts) + 1], axis = 1)
+
+    def centroids(self):
+        #(mean row, mean col) of each mask
+        if not len(self):
+            return np.zeros((0, 2))
+        rows, cols = np.divmod(self.indices, self.shape[1])
+        sizes = self.sizes()
+        starts = self.indptr[:-1]
+        return np.stack([np.add.reduceat(rows, starts) / sizes, np.add.reduceat(cols, starts) / sizes], axis = 1)
+
+    def overlap(self, other):
+        #pairs of masks of self and other (of the same shape) which share pixels: (ids of self, ids of other,
+        #number of pixels shared)
+        _, mine, theirs = np.intersect1d(self.indices, other.indices, assume_unique = True, return_indices = True)
+        pairs, counts = np.unique(np.stack([self.labels()[mine], other.labels()[theirs]]), axis = 1, return_counts = True)
+        return pairs[0], pairs[1], counts
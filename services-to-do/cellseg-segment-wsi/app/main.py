@@ -32,14 +32,19 @@ class CellSegWSIProcessInput:
 
     @dataclass
     class ServiceParameters:
+        # Frontier grows every mask at once (much faster on a whole slide), it never takes pixels of another mask so
+        # it can differ from Sequential where cells touch
         class GrowMethod(str, Enum):
             Sequential = 'Sequential'
+            Frontier = 'Frontier'
         overlap: int = 80
         threshold: int = 20
         increase_factor: int = 1
         grow_mask: bool = True
         grow_pixels: int = 10
         grow_method: GrowMethod = GrowMethod.Sequential
+        # Frontier growth is split into tiles over this many processes when > 1
+        grow_workers: int = 1
         
 
     service_parameters: ServiceParameters
@@ -80,7 +85,8 @@ class CellSegWSI(CellSegmentation,Automated):
                     increase_factor=input.service_parameters.increase_factor, 
                     grow_mask=input.service_parameters.grow_mask,
                     grow_pixels=input.service_parameters.grow_pixels,
-                    grow_method=input.service_parameters.grow_method
+                    grow_method=input.service_parameters.grow_method,
+                    grow_workers=input.service_parameters.grow_workers
                     )
             
             wsi = WholeSlideImageCellSegmentationMask(
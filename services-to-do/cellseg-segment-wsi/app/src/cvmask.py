@@ -11,13 +11,37 @@ from operator import itemgetter
 from skimage.measure import find_contours
 from skimage.morphology import disk, dilation
 from scipy.ndimage.morphology import binary_dilation
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import sys
 from sklearn.neighbors import kneighbors_graph
-from scipy.spatial.distance import cdist
+from src.cvsparse import SparseMasks
 
 IMAGEJ_BAND_WIDTH = 200
 EIGHT_BIT_MAX = 255
+# Size of the tiles 'Frontier' growth splits the image into when it runs on more than one worker
+GROW_TILE_SIZE = 2048
+
+# Grows every mask at once, one ring of pixels per step: each background pixel next to a mask (4-connectivity) joins
+# it, a pixel reached by several masks in the same step joining the highest id (the Sequential loop visits masks in
+# id order and the last to reach a pixel keeps it).  Pixels of a mask are never taken by another
+def grow_frontier(masks, growth):
+    masks = np.array(masks, copy = True)
+    grown = np.empty_like(masks)
+    for _ in range(growth):
+        #highest id among each pixel and its 4 neighbours (a grey dilation with disk(1))
+        grown[...] = masks
+        np.maximum(grown[1:], masks[:-1], out = grown[1:])
+        np.maximum(grown[:-1], masks[1:], out = grown[:-1])
+        np.maximum(grown[:, 1:], masks[:, :-1], out = grown[:, 1:])
+        np.maximum(grown[:, :-1], masks[:, 1:], out = grown[:, :-1])
+        np.copyto(masks, grown, where = masks == 0)
+    return masks
+
+# Grows one tile with a halo of growth pixels, the halo is wide enough that the core of the tile comes out as it
+# would growing the whole image (a ring spreads one pixel per step)
+def _grow_tile(window, growth, core):
+    return grow_frontier(window, growth)[core]
 
 class CVMask():
     '''
@@ -98,26 +122,16 @@ class CVMask():
         return compensated_means, means, channel_counts[:,0]
 
     def compute_centroids(self):
-        masks = self.flatmasks
-        num_masks = len(np.unique(masks)) - 1
-        indices = np.where(masks != 0)
-        values = masks[indices[0], indices[1]]
-
-        maskframe = pd.DataFrame(np.transpose(np.array([indices[0], indices[1], values]))).rename(columns = {0:"x", 1:"y", 2:"id"})
-        centroids = maskframe.groupby('id').agg({'x': 'mean', 'y': 'mean'}).to_records(index = False).tolist()
+        centroids = SparseMasks.from_flat(self.flatmasks).centroids()
         
-        self.centroids = centroids
+        self.centroids = [tuple(c) for c in centroids.tolist()]
         
         
     def compute_boundbox(self):
-        masks = self.flatmasks
-        num_masks = len(np.unique(masks)) - 1
-        indices = np.where(masks != 0)
-        values = masks[indices[0], indices[1]]
-
-        maskframe = pd.DataFrame(np.transpose(np.array([indices[0], indices[1], values]))).rename(columns = {0:"y", 1:"x", 2:"id"})
-        self.bb_mins = maskframe.groupby('id').agg({'y': 'min', 'x': 'min'}).to_records(index = False).tolist()
-        self.bb_maxes = maskframe.groupby('id').agg({'y': 'max', 'x': 'max'}).to_records(index = False).tolist()
+        bbox = SparseMasks.from_flat(self.flatmasks).bbox()
+        #inclusive maxes
+        self.bb_mins = [tuple(b) for b in bbox[:, :2].tolist()]
+        self.bb_maxes = [tuple(b) for b in (bbox[:, 2:] - 1).tolist()]
     
     def absolute_centroids(self, tile_row, tile_col):
         y_offset = self.flatmasks.shape[0] * (tile_row - 1)
@@ -144,26 +158,62 @@ class CVMask():
             
     def remove_overlaps_nearest_neighbors(self, masks):
         final_masks = np.max(masks, axis = 2)
-        centroids = self.centroids
+        centroids = np.array(self.centroids, dtype = np.float64).reshape(-1, 2)
         collisions = np.nonzero(np.sum(masks > 0, axis = 2) > 1)
-        collision_masks = masks[collisions]
-        collision_index = np.nonzero(collision_masks)
-        collision_masks = collision_masks[collision_index]
-        collision_frame = pd.DataFrame(np.transpose(np.array([collision_index[0], collision_masks]))).rename(columns = {0:"collis_idx", 1:"mask_id"})
-        grouped_frame = collision_frame.groupby('collis_idx')
-        for collis_idx, group in grouped_frame:
-            collis_pos = np.expand_dims(np.array([collisions[0][collis_idx], collisions[1][collis_idx]]), axis = 0)
-            prevval = final_masks[collis_pos[0,0], collis_pos[0,1]]
-            mask_ids = list(group['mask_id'])
-            curr_centroids = np.array([centroids[mask_id - 1] for mask_id in mask_ids])
-            dists = cdist(curr_centroids, collis_pos)
-            closest_mask = mask_ids[np.argmin(dists)]
-            final_masks[collis_pos[0,0], collis_pos[0,1]] = closest_mask
+        #every collision pixel at once: the distance from the pixel to the centroid of each mask on it (in layer
+        #order), the closest (the first of them on ties) keeps the pixel
+        collision_masks = masks[collisions].astype(np.int64)
+        on_pixel = collision_masks > 0
+        curr_centroids = centroids[np.where(on_pixel, collision_masks - 1, 0)]
+        dy = curr_centroids[..., 0] - collisions[0][:, None]
+        dx = curr_centroids[..., 1] - collisions[1][:, None]
+        dists = np.where(on_pixel, np.sqrt(dy * dy + dx * dx), np.inf)
+        closest = np.argmin(dists, axis = 1)
+        final_masks[collisions] = collision_masks[np.arange(len(closest)), closest]
         
         return final_masks
+
+    # Layer of each mask for 'Standard' growth, given the (sparse) kNN graph of their centroids: masks are taken in
+    # order and each gets the first layer missing from the sorted layers of its neighbours taken before it.  Masks
+    # whose earlier neighbours all have a layer don't depend on each other, so they're assigned together, a wave at
+    # a time
+    def assign_layers(self, connectivity):
+        connectivity = connectivity.tocsr()
+        n = connectivity.shape[0]
+        rows = np.repeat(np.arange(n), np.diff(connectivity.indptr))
+        cols = connectivity.indices
+        earlier = cols < rows
+        src, dst = rows[earlier], cols[earlier]
+        #the earlier neighbours of each mask, padded with -1
+        counts = np.bincount(src, minlength = n)
+        width = max(int(counts.max(initial = 0)), 1)
+        neighbours = np.full((n, width), -1, dtype = np.int64)
+        neighbours[src, np.arange(len(src)) - np.repeat(np.cumsum(counts) - counts, counts)] = dst
+        #the masks waiting on each mask, grouped by the mask they wait on
+        order = np.argsort(dst, kind = 'stable')
+        waiting, waiting_ptr = src[order], np.searchsorted(dst[order], np.arange(n + 1))
+
+        layers = np.full(n, -1, dtype = np.int64)
+        pending = counts.copy()
+        ready = np.flatnonzero(pending == 0)
+        while len(ready):
+            nbrs = neighbours[ready]
+            used = np.sort(np.where(nbrs >= 0, layers[nbrs], np.iinfo(np.int64).max), axis = 1)
+            #the first position where the sorted layers stop counting 0, 1, 2, ...
+            gaps = used != np.arange(width)
+            layers[ready] = np.where(gaps.any(axis = 1), np.argmax(gaps, axis = 1), width)
+
+            starts, ends = waiting_ptr[ready], waiting_ptr[ready + 1]
+            lengths = ends - starts
+            released = waiting[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())]
+            released, released_counts = np.unique(released, return_counts = True)
+            pending[released] -= released_counts
+            ready = released[pending[released] == 0]
+
+        return layers
              
-    def grow_masks(self, growth, method = 'Standard', num_neighbors = 30):
-        assert method in ['Standard', 'Sequential']
+    def grow_masks(self, growth, method = 'Standard', num_neighbors = 30, workers = 1):
+        assert method in ['Standard', 'Sequential', 'Frontier']
         
         masks = self.flatmasks
         num_masks = len(np.unique(masks)) - 1
@@ -171,36 +221,20 @@ class CVMask():
         if method == 'Standard':
             print("Standard growth selected")
             masks = self.flatmasks
-            num_masks = len(np.unique(masks)) - 1
-            indices = np.where(masks != 0)
-            values = masks[indices[0], indices[1]]
-
-            maskframe = pd.DataFrame(np.transpose(np.array([indices[0], indices[1], values]))).rename(columns = {0:"x", 1:"y", 2:"id"})
-            cent_array = maskframe.groupby('id').agg({'x': 'mean', 'y': 'mean'}).to_numpy()
-            connectivity_matrix = kneighbors_graph(cent_array, num_neighbors).toarray() * np.arange(1, num_masks + 1)
-            connectivity_matrix = connectivity_matrix.astype(int)
-            labels = {}
-            for n in range(num_masks):
-                connections = list(connectivity_matrix[n, :])
-                connections.remove(0)
-                layers_used = [labels[i] for i in connections if i in labels]
-                layers_used.sort()
-                currlayer = 0
-                for layer in layers_used:
-                    if currlayer != layer: 
-                        break
-                    currlayer += 1
-                labels[n + 1] = currlayer
-
-            possible_layers = len(list(set(labels.values())))
-            label_frame = pd.DataFrame(list(labels.items()), columns = ["maskid", "layer"])
+            cent_array = SparseMasks.from_flat(masks).centroids()
+            #kept sparse, a dense N x N matrix doesn't fit in memory for a whole slide
+            connectivity_matrix = kneighbors_graph(cent_array, num_neighbors)
+            layer_of = self.assign_layers(connectivity_matrix)
+
+            possible_layers = int(layer_of.max(initial = -1)) + 1
             image_h, image_w = masks.shape
             expanded_masks = np.zeros((image_h, image_w, possible_layers), dtype = np.uint32)
 
-            grouped_frame = label_frame.groupby('layer')
-            for layer, group in grouped_frame:
-                currids = list(group['maskid'])
-                masklocs = np.isin(masks, currids)
+            #layer of each pixel's mask, through a lookup table indexed by mask id
+            layer_lut = np.append(-1, layer_of)
+            pixel_layers = layer_lut[masks]
+            for layer in range(possible_layers):
+                masklocs = pixel_layers == layer
                 expanded_masks[masklocs, layer] = masks[masklocs]
 
             dilation_mask = disk(1)
@@ -249,6 +283,32 @@ class CVMask():
 
             self.flatmasks = masks
 
+        elif method == 'Frontier':
+            #the same as Sequential for cells which don't touch, where they do Frontier never takes a pixel which already
+            #belongs to another mask, while Sequential lets a growing mask take its neighbours' edge pixels
+            print("Frontier growth selected")
+            if workers > 1:
+                self.flatmasks = self.grow_frontier_tiled(masks, growth, workers)
+            else:
+                self.flatmasks = grow_frontier(masks, growth)
+
+    # Frontier growth over halo'd tiles, on a pool of worker processes
+    def grow_frontier_tiled(self, masks, growth, workers, tile_size = GROW_TILE_SIZE):
+        Y, X = masks.shape
+        grown = np.empty_like(masks)
+        windows, cores, targets = [], [], []
+        for y in range(0, Y, tile_size):
+            for x in range(0, X, tile_size):
+                y1, x1 = max(y - growth, 0), max(x - growth, 0)
+                y2, x2 = min(y + tile_size + growth, Y), min(x + tile_size + growth, X)
+                windows.append(masks[y1:y2, x1:x2])
+                cores.append((slice(y - y1, min(y + tile_size, Y) - y1), slice(x - x1, min(x + tile_size, X) - x1)))
+                targets.append((slice(y, min(y + tile_size, Y)), slice(x, min(x + tile_size, X))))
+        with ProcessPoolExecutor(max_workers = workers) as pool:
+            for target, tile in zip(targets, pool.map(_grow_tile, windows, [growth] * len(windows), cores)):
+                grown[target] = tile
+        return grown
+
     def sort_into_strips(self):
         N = self.n_instances()
         unsorted = []
@@ -9,6 +9,7 @@ import src.cvmodel as modellib
 import time
 # relative import of config
 from src.cvmodelconfig import CVSegmentationConfig
+from src.cvsparse import SparseMasks
 
 AUTOSIZE_MAX_SIZE = 800
 # Maps image height, width to nrows, ncols to slice into for inference.
@@ -84,16 +85,8 @@ class CVSegmenter:
                 #mask = mask[:, :, 1:]
                 if mask.shape[2] == 0:
                     print('Warning: no cell instances were detected for a crop.')
-                nmasks = mask.shape[2]
-                maskarr = []
-                if nmasks > 0:
-                    maskarr = np.zeros((mask[0].shape[0], mask[0].shape[1]), dtype = np.int32)
-                    maskarr = np.max(np.arange(1, nmasks + 1, dtype=np.int32)[None,None,:]*mask, axis=2)
-                else:
-                    ypix, xpix, _ = mask.shape
-                    maskarr = np.zeros((ypix, xpix), dtype = np.int32)
-                    
-                masks.append(maskarr)
+                #the pixels of each detected cell, rather than a label image built through an int stack of every cell
+                masks.append(SparseMasks.from_instances(mask))
                 stop = time.time()
                 print(f"Segmented crop in {stop-start} seconds.")
 
@@ -4,8 +4,25 @@
 
 import numpy as np
 from math import ceil
-import matplotlib.pyplot as plt
-import pandas as pd
+from src.cvsparse import SparseMasks
+
+# Filters the labels of a mask in one pass: counts the pixels of every label, builds a lookup table of the labels to
+# keep and applies it with a single gather, rather than scanning the mask once per label.
+# Labels of threshold pixels or fewer are removed (set to 0). The others keep their ids or, given an offset, are
+# renumbered consecutively from offset + 1 in order of id. Returns the new mask with the ids and sizes of the labels
+# kept (before renumbering, background included as np.unique would give them)
+def filter_labels(mask, threshold=0, offset=None):
+    counts = np.bincount(mask.ravel())
+    ids = np.flatnonzero(counts)
+    sizes = counts[ids]
+    keep = sizes > threshold
+    ids, sizes = ids[keep], sizes[keep]
+
+    labels = ids[ids > 0]
+    new_ids = labels if offset is None else np.arange(offset + 1, offset + len(labels) + 1)
+    lut = np.zeros(len(counts), dtype=np.result_type(mask.dtype, np.min_scalar_type(new_ids.max(initial=0))))
+    lut[labels] = new_ids
+    return lut[mask], sizes, ids
 
 class CVMaskStitcher():
     """
@@ -23,162 +40,123 @@ class CVMaskStitcher():
         prev_max = 0
 
         for i, crop in enumerate(masks):
-            if np.any(crop.astype(bool)):
-                newcrop = np.copy(crop)
-                newcrop[crop > 0] += prev_max
-                prev_max += len(np.unique(newcrop)) - 1
-                masks[i] = newcrop
+            masks[i] = crop.renumber(prev_max)
+            prev_max += len(crop)
 
         return masks
     
     def flat_to_expanded(self, planemasks):
-        mask_arr_h, mask_arr_w = planemasks.shape
-        num_masks = len(np.unique(planemasks)) - 1
-        expanded_mask_arr = np.zeros((mask_arr_h, mask_arr_w, num_masks + 1), dtype = bool)
-        flat_mask_arr = planemasks.flatten()
-        oldmaskids = np.sort(np.unique(flat_mask_arr))
-        newmaskids = np.arange(len(oldmaskids))
-        maskmap = dict(zip(oldmaskids, newmaskids))
-        flat_mask_arr = np.vectorize(maskmap.get)(flat_mask_arr)
-        row_indices = np.repeat(np.arange(mask_arr_h), mask_arr_w)
-        col_indices = np.array(list(np.arange(mask_arr_w)) * mask_arr_h)
-        index_array = [row_indices, col_indices, flat_mask_arr]
-        flat_index_array = np.ravel_multi_index(
-            index_array,
-            expanded_mask_arr.shape)
-        np.ravel(expanded_mask_arr)[flat_index_array] = True
-        expanded_mask_arr = expanded_mask_arr[:, :, 1:]
+        #dense (height, width, n) boolean stack of the masks, numbered consecutively (only for export, the pipeline
+        #passes SparseMasks)
+        sparse = SparseMasks.from_flat(planemasks)
+        expanded_mask_arr = np.zeros(planemasks.shape + (len(sparse),), dtype = bool)
+        layers = np.repeat(np.arange(len(sparse)), sparse.sizes())
+        np.ravel(expanded_mask_arr)[sparse.indices * len(sparse) + layers] = True
         
         return expanded_mask_arr
 
-    def stitch_masks(self, masks, nrows, ncols):
-        #if there was no cropping for segmentation, return the segmented image
+    def stitch_masks(self, masks, nrows, ncols, out=None):
+        #crops are SparseMasks (from the segmenter) or label images
+        masks = [crop if isinstance(crop, SparseMasks) else SparseMasks.from_flat(crop) for crop in masks]
+
+        #if there was no cropping for segmentation, return the segmented image (masks numbered consecutively)
         if len(masks) == 1: 
-            return self.flat_to_expanded(masks[0])
+            return masks[0].renumber().flatten()
         
         assert(len(masks) == nrows * ncols)
         
-        masks = self.renumber_masks(masks)
-
         #overlap is the amount of overlap between crops, which is set to 80 pixels as default
 
-        #first remove cells under a certain size to get rid of artifacts
+        #first remove cells under a certain size to get rid of artifacts, then renumber the crops' masks (on the
+        #pixel lists, no crop is turned into a label image)
         print(f"Removing masks with area less than {self.threshold} pixels.")
-        mask_ids = []
-        mask_sizes = []
         for i in range(len(masks)):
-            masks[i], sizes, ids = self.remove_small_cells(masks[i])
-            mask_sizes.extend(sizes)
-            mask_ids.extend(ids)
-            
-        size_dict = dict(zip(mask_ids, mask_sizes))
-
-        del mask_ids, mask_sizes
+            masks[i], _, _ = self.remove_small_cells(masks[i])
+        masks = self.renumber_masks(masks)
 
-        h, w = masks[0].shape
-        
-        strip_w, strip_h = 0, 0
-        
-        if ncols == 1:
-            strip_w = w
-        else:
-            strip_w = (w * 2) + (w + int(self.overlap / 2)) * (ncols - 2) - self.overlap * (ncols - 1)
-        
-        if nrows == 1:
-            strip_h = h
-        else:
-            strip_h = (h * 2) + (h + int(self.overlap / 2)) * (nrows - 2) - self.overlap * (nrows - 1)
-
-        nlayers = 4
-
-        expanded_mask_arr = np.zeros((strip_h, strip_w, nlayers), dtype = np.int32)
-
-        layer_to_populate_1 = 0
-        curr_left = 0
-        curr_top = 0
-        cropshape = (0,0)
-
-        for i in range(0, len(masks), ncols):
-            curr_left = 0
-            currrow = int(i / ncols)
-
-            if currrow % 2 == 0:
-                layer_to_populate_1 = 0
-            else:
-                layer_to_populate_1 = 2
-
-            for j in range(i, i + ncols):
-                currmasks = masks[j]
-                currcol = j - i
-                cropshape = currmasks.shape
-                layer_to_populate = layer_to_populate_1 + (currcol % 2)
-                expanded_mask_arr[curr_top:(curr_top + cropshape[0]), curr_left:(curr_left + cropshape[1]), layer_to_populate] = currmasks
-                curr_left += cropshape[1] - self.overlap
-                
-            curr_top += cropshape[0] - self.overlap
-               
-                
-        mask_overlaps = np.sum(expanded_mask_arr > 0, axis = 2) > 1
-        mask_overlaps_compress = np.zeros((4, np.sum(mask_overlaps)), dtype = np.int32)
-
-        for i in range(nlayers):
-            mask_overlaps_compress[i, :] = expanded_mask_arr[:, :, i][mask_overlaps]
-
-        mask_conflicts = np.unique(mask_overlaps_compress, axis = 1)
-
-        del mask_overlaps, mask_overlaps_compress
-
-        num_conflicts = mask_conflicts.shape[1]
-        
-        #now compare mask sizes of overlapping masks, only keeping the largest mask in each conflict 
-        #and removing all other masks
+        #size of every mask, indexed by id (ids are unique across crops after renumbering), -1 where there's no mask
+        mask_sizes = np.full(sum(len(crop) for crop in masks) + 1, -1, dtype=np.int64)
+        for crop in masks:
+            mask_sizes[crop.ids] = crop.sizes()
+
+        tops, lefts = self.crop_offsets(masks, nrows, ncols)
+
+        #only the bands where neighbouring crops overlap can hold conflicting masks, of each conflict only the
+        #largest mask is kept and all other masks are removed (from every crop they appear in)
+        masks_to_rem = self.resolve_seams(masks, nrows, ncols, tops, lefts, mask_sizes)
+
+        #lookup table from the ids of the masks kept to consecutive ids, removed masks to 0
+        keep = mask_sizes > 0
+        keep[masks_to_rem] = False
+        lut = np.zeros(len(mask_sizes), dtype=np.uint32)
+        lut[keep] = np.arange(1, np.count_nonzero(keep) + 1, dtype=np.uint32)
+
+        #write the resolved crops into the output (any uint32 array of the slide's shape, e.g. a np.memmap to stitch
+        #into a file) one at a time from their pixel lists, at most one crop has a mask left at each pixel of an
+        #overlap so the maximum is that mask
+        strip_h = tops[-1] + masks[(nrows - 1) * ncols].shape[0]
+        strip_w = lefts[-1] + masks[ncols - 1].shape[1]
+        if out is None:
+            out = np.zeros((strip_h, strip_w), dtype=np.uint32)
+        for i, crop in enumerate(masks):
+            top, left = tops[i // ncols], lefts[i % ncols]
+            region = out[top:(top + crop.shape[0]), left:(left + crop.shape[1])]
+            labels = lut[crop.labels()]
+            kept = labels > 0
+            rows, cols = np.divmod(crop.indices[kept], crop.shape[1])
+            region[rows, cols] = np.maximum(region[rows, cols], labels[kept])
+
+        return out
+
+    # Top of each row and left of each column of crops in the stitched mask, neighbouring crops overlap by self.overlap
+    def crop_offsets(self, masks, nrows, ncols):
+        tops = [0]
+        for row in range(nrows - 1):
+            tops.append(tops[-1] + masks[row * ncols].shape[0] - self.overlap)
+        lefts = [0]
+        for col in range(ncols - 1):
+            lefts.append(lefts[-1] + masks[col].shape[1] - self.overlap)
+        return tops, lefts
+
+    # Intervals along one axis with the crops (row or column indices) covering each, given each crop's start and size
+    def covering_intervals(self, starts, sizes):
+        bounds = sorted(set(starts) | set(s + n for s, n in zip(starts, sizes)))
+        intervals = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            covering = [k for k, (s, n) in enumerate(zip(starts, sizes)) if s <= lo and hi <= s + n]
+            intervals.append((lo, hi, covering))
+        return intervals
+
+    # Ids of the masks which lose a conflict. Each cell of an overlap band is resolved on a stack of just the crops
+    # covering it, in the order of their layers (crops alternate between 4 layers by row and column parity), so ties
+    # are broken as when every crop was stacked into a 4 layer array of the whole slide
+    def resolve_seams(self, masks, nrows, ncols, tops, lefts, mask_sizes):
+        row_intervals = self.covering_intervals(tops, [masks[row * ncols].shape[0] for row in range(nrows)])
+        col_intervals = self.covering_intervals(lefts, [masks[col].shape[1] for col in range(ncols)])
 
         masks_to_rem = []
-
-        for i in range(num_conflicts):
-            idlist = mask_conflicts[:, i]
-            idlist = [f for f in idlist if f > 0]
-            currsizes = [size_dict.get(maskid) for maskid in idlist]
-            largest_mask_idx = np.argmax(np.array(currsizes))
-            largest_mask = idlist[largest_mask_idx]
-            remlist = [f for f in idlist if f != largest_mask]
-            masks_to_rem.extend(remlist)
-
-        masks_to_rem = list(set(masks_to_rem)) #get just unique ids in list
-        masklocs = np.isin(expanded_mask_arr, masks_to_rem)
-        expanded_mask_arr[masklocs] = 0
-        full_mask_arr = np.sum(expanded_mask_arr, axis = 2)
-        num_masks = len(np.unique(full_mask_arr)) - 1
-        print("Showing stitched masks")
-        plt.imshow(full_mask_arr > 0)
-        plt.show()
-        #warn users if the number of masks discovered in the image will crash the program
-        mask_arr_h, mask_arr_w = full_mask_arr.shape
-        #expected_memory_gb = mask_arr_h * mask_arr_w * (num_masks + 1) / 1e9
-        #if expected_memory_gb > self.memory_max:
-        #    warnings.warn(f"The number of masks found and dimensions of image will cause program to exceed {self.memory_max + 1} GB memory usage. Consider splitting image into subtiles and segmenting them individually.", UserWarning)
-        
-        #expanded_masks = self.flat_to_expanded(full_mask_arr)
-        
-        #renumber the indices before returning array
-        indices = np.nonzero(full_mask_arr)
-        values = full_mask_arr[indices]
-        valframe = pd.DataFrame(np.transpose(np.array([indices[0], indices[1], values]))).rename(columns = {0:"x", 1:"y", 2:"idx"})
-        valframe = valframe.sort_values(by = 'idx')
-        num_idx = valframe['idx'].value_counts(sort = False).sort_index().tolist()
-        valframe['idx'] = np.repeat(np.arange(1, num_masks + 1), num_idx)
-        valarray = valframe.to_numpy()
-        full_mask_arr[valarray[:, 0], valarray[:, 1]] = valarray[:, 2]
-
-        #return expanded_masks
-        return full_mask_arr
+        for y1, y2, rows in row_intervals:
+            for x1, x2, cols in col_intervals:
+                if len(rows) * len(cols) < 2:
+                    continue
+                crops = sorted(((row % 2) * 2 + (col % 2), row * ncols + col) for row in rows for col in cols)
+                #label images of just the window of each crop, from its pixel lists
+                seam = np.stack([
+                    masks[j].window(y1 - tops[j // ncols], x1 - lefts[j % ncols], y2 - y1, x2 - x1).ravel()
+                    for _, j in crops])
+                #only pixels with more than one mask are conflicts
+                seam = seam[:, np.count_nonzero(seam, axis = 0) > 1]
+                #the first of the largest masks at each pixel wins, every other mask there is removed
+                winners = np.argmax(mask_sizes[seam], axis = 0)
+                losers = seam > 0
+                losers[winners, np.arange(seam.shape[1])] = False
+                masks_to_rem.append(np.unique(seam[losers]))
+
+        return np.concatenate(masks_to_rem) if masks_to_rem else np.zeros(0, dtype=np.int64)
 
     # Remove any cells smaller than the defined threshold.
     def remove_small_cells(self, mask):
-        mask_id, sizes = np.unique(mask, return_counts = True)
-        keep_indices = list(sizes > self.threshold)
-        for currid, keep_id in zip(mask_id, keep_indices):
-            if not keep_id:
-                mask[mask == currid] = 0
+        keep = mask.sizes() > self.threshold
+        mask = mask.select(keep)
 
-        return mask, list(sizes[keep_indices]), list(mask_id[keep_indices])
+        return mask, list(mask.sizes()), list(mask.ids)
@@ -3,28 +3,137 @@ from PIL import Image, TiffImagePlugin
 Image.MAX_IMAGE_PIXELS = None
 # from sklearn.multioutput import MultiOutputRegressor
 # from sklearn.ensemble import RandomForestRegressor
-import pickle
 import numpy as np
-from pathlib import Path
 import os
-this_dir, this_filename = os.path.split(__file__) 
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import tifffile
+from cdb_cellmaps._config import Config as _Config
+from cdb_cellmaps._utils import download_stacked_tiff_locally
 
-# perhaps replace this with something such as skops to be more secure! \
-    # https://scikit-learn.org/stable/model_persistence.html#security-maintainability-limitations
-f = open(Path(this_dir)/ 'models' /'ace_clf.pkl','rb')
-clf = pickle.load(f)
+import ace_model #type: ignore
+
+# Number of channels histogrammed / contrast adjusted and written concurrently
+ACE_WORKERS = int(os.getenv('ACE_WORKERS', os.cpu_count() or 1))
+# Share of the available memory the contrast adjustments may use between them, caps the number adjusted at once
+MEMORY_FRACTION = float(os.getenv('ACE_MEMORY_FRACTION', 0.75))
+# Peak bytes per pixel of adjusting one channel: the decoded image, its array copy, the lookup output and its image
+ADJUST_BYTES_PER_PIXEL = 4
 
 
 def fastACE(img: Union[Image.Image,TiffImagePlugin.TiffImageFile]):
     assert type(img) == TiffImagePlugin.TiffImageFile or type(img) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(img)}'
     # Get the histogram for the image
     im_hist = np.array(img.histogram())
-    # Now normalize this histogram so it's agmnostic of the Image size
-    im_hist = im_hist / im_hist.sum()
-    # pass the normalized histogram through the classifer, reshaping as there's only 1 sample being passed in
-    tmin, tmax = clf.predict(im_hist.reshape(1,-1))[0]
+    # pass the histogram through the classifer (which normalizes it), reshaping as there's only 1 sample being passed in
+    tmin, tmax = predict_thresholds(im_hist.reshape(1,-1))[0]
     # Using the predicted thresholds, apply the contrast function and return the adjusted Image 
-    return contrast_function_8bit(img,int(tmin),int(tmax)), (int(tmin), int(tmax))
+    return contrast_function_8bit(img,tmin,tmax), (tmin, tmax)
+
+
+def predict_thresholds(histograms: np.ndarray):
+    # One classifier call for N histograms (N x 256), returns the (tmin, tmax) thresholds of each
+    # Normalize the histograms so they're agnostic of the Image size
+    histograms = histograms / histograms.sum(axis=1, keepdims=True)
+    return [(int(tmin), int(tmax)) for tmin, tmax in ace_model.predict(histograms)]
+
+
+@contextmanager
+def local_tiff_path(file):
+    # In debug mode the url is already a local path, otherwise stage the object to local disk for random access
+    if _Config.DEBUG() or os.path.exists(file.url):
+        yield file.url
+    else:
+        local_path = download_stacked_tiff_locally(file.url)
+        try:
+            yield local_path
+        finally:
+            os.remove(local_path)
+
+
+def streamed_histogram(path) -> np.ndarray:
+    # The same histogram as PIL's Image.histogram, computed one strip / tile at a time rather than decoding the whole image
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages[0]
+        if page.dtype != np.uint8 or page.samplesperpixel != 1:
+            with Image.open(path) as img:
+                return np.array(img.histogram())
+        hist = np.zeros(256, dtype=np.int64)
+        fh = page.parent.filehandle
+        for index, (offset, bytecount) in enumerate(zip(page.dataoffsets, page.databytecounts)):
+            fh.seek(offset)
+            segment, (_, _, top, left, _), _ = page.decode(fh.read(bytecount), index, jpegtables=page.jpegtables)
+            if segment is None:
+                continue
+            # Tiles at the edges of the image are padded, only count the pixels inside the image
+            segment = segment[0, :page.imagelength - top, :page.imagewidth - left, 0]
+            hist += np.bincount(segment.ravel(), minlength=256)
+        # Empty segments are implicitly zero
+        hist[0] += page.imagelength * page.imagewidth - hist.sum()
+        return hist
+
+
+def batch_ACE(files: dict, write, workers: int = ACE_WORKERS) -> dict:
+    # Runs ACE on many channels (keyed by any hashable), write(key, image) is called for each adjusted channel
+    # and its return value collected in the output dict, which is in the same order as files
+    # Outside debug mode every channel is downloaded twice, once for its histogram and again for its adjustment.
+    # The thresholds come from one classifier call over every histogram, so keeping the staged copies until their
+    # adjustment would put every channel of the job on local disk at once; the second download trades object
+    # store traffic for local disk bounded by the channels in flight
+    files = dict(files.items())
+    keys = list(files)
+    if not keys:
+        return {}
+
+    # Histogram each channel from a staged copy, which is removed as soon as its histogram is computed (so only
+    # the channels being histogrammed are on local disk at once)
+    def histogram(key):
+        with local_tiff_path(files[key]) as path:
+            return streamed_histogram(path), channel_shape(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        histograms, shapes = zip(*executor.map(histogram, keys))
+    # Thresholds for every channel from a single classifier call
+    thresholds = dict(zip(keys, predict_thresholds(np.stack(histograms))))
+
+    # Each channel is staged again for its adjustment, which decodes it whole, so the number adjusted at once is
+    # limited by memory rather than by the number of cpus
+    def adjust_and_write(key):
+        with local_tiff_path(files[key]) as path, Image.open(path) as img:
+            new_im = contrast_function_8bit(img, *thresholds[key])
+        return write(key, new_im)
+
+    with ThreadPoolExecutor(max_workers=concurrency_limit(shapes, workers)) as executor:
+        return dict(zip(keys, executor.map(adjust_and_write, keys)))
+
+
+def channel_shape(path):
+    with tifffile.TiffFile(path) as tif:
+        return tif.pages[0].shape[:2]
+
+
+def available_memory() -> int:
+    # Memory available to this container, the cgroup limit takes precedence over the free memory of the node
+    available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    for limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            if limit != 'max':
+                available = min(available, int(limit))
+            break
+        except (OSError, ValueError):
+            continue
+    return available
+
+
+def concurrency_limit(shapes, workers) -> int:
+    workers = max(1, min(workers, len(shapes)))
+    if workers == 1:
+        return 1
+    # Budget for the largest channel, so any mix of channels in flight fits
+    per_channel = max(height * width for height, width in shapes) * ADJUST_BYTES_PER_PIXEL
+    return max(1, min(workers, int(available_memory() * MEMORY_FRACTION) // max(per_channel, 1)))
 
 
 def contrast_function_8bit(img, min,max):
@@ -43,6 +152,14 @@ def contrast_function_8bit(img, min,max):
             return np.uint8((((px - min) / max) * output_max))
     
     vect_func = np.vectorize(rescale_pixel)
-    
-    return Image.fromarray(np.uint8(vect_func(np.array(img))))
+
+    arr = np.array(img)
+    if arr.dtype.kind != 'u':
+        return Image.fromarray(np.uint8(vect_func(arr)))
+
+    # The mapping only depends on the pixel value, so evaluate it once per possible value (256 for an 8bit image)
+    # and apply it to the image with a single lookup, rather than calling rescale_pixel for every pixel
+    lut = np.uint8(vect_func(np.arange(int(arr.max(initial=255)) + 1, dtype=arr.dtype)))
+
+    return Image.fromarray(lut[arr])
          
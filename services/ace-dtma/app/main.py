@@ -49,16 +49,25 @@ class AceDTMA(TechnicalVarianceCorrection,Automated):
         
         temp = DearrayedTissueMicroArray()
 
-        for core_name, core in input.data.dearrayed_tissue_micro_array.items():
+        # Every channel of every core in one batch, keyed by (core, channel)
+        channels = {
+            (core_name, channel_name): channel
+            for core_name, core in input.data.dearrayed_tissue_micro_array.items()
+            for channel_name, channel in core.items()
+        }
+        # Need to correct the prefix-writing
+        # prefix is the workflow-id + service-name (& timestamp)
+        written = ace.batch_ACE(
+            channels,
+            lambda key, new_im: TissueCoreProteinChannel.write(
+                data = new_im,
+                prefix=prefix.add_level(key[0]),
+                file_name=key[1]))
+
+        for core_name, _ in input.data.dearrayed_tissue_micro_array.items():
             temp[core_name] = TissueCore()
-            for channel_name, channel in core.items():
-                new_im, thresholds = ace.fastACE(channel.read())
-                # Need to correct the prefix-writing
-                prefix # This is the workflow-id + service-name (& timestamp)
-                temp[core_name][channel_name] = TissueCoreProteinChannel.write(
-                    data = new_im,
-                    prefix=prefix.add_level(core_name),
-                    file_name=channel_name)
+        for (core_name, channel_name), channel in written.items():
+            temp[core_name][channel_name] = channel
         
         return AceDTMAProcessOutput(
             data=AceDTMAProcessOutput.Data(
@@ -0,0 +1,176 @@
+# Serving of the ACE threshold regressor
+# The model is loaded lazily on first use and cached for the life of the process. If an exported copy of the
+# forest (flattened tree arrays, see export_model) is present it is used instead of the pickle for small batches,
+# predictions then run in vectorized NumPy and sklearn isn't imported at all. Large batches still go to sklearn,
+# whose compiled tree walk is faster per sample than NumPy's
+from functools import lru_cache
+from pathlib import Path
+import os
+import pickle
+import sys
+
+import numpy as np
+
+this_dir, this_filename = os.path.split(__file__)
+
+MODEL_PATH = Path(this_dir) / 'models' / 'ace_clf.pkl'
+EXPORTED_MODEL_PATH = Path(this_dir) / 'models' / 'ace_clf.npz'
+# 'auto' uses the exported model if it exists, 'sklearn' / 'exported' force one or the other
+MODEL_FORMAT = os.getenv('ACE_MODEL_FORMAT', 'auto')
+# With 'auto', batches of more histograms than this are predicted by the sklearn model (see get_model)
+FLAT_BATCH_LIMIT = int(os.getenv('ACE_FLAT_BATCH_LIMIT', 512))
+# Levels the exported forest's walks advance between dropping the finished ones
+WALK_LEVELS = 4
+
+
+class FlatForest():
+    """
+    A random forest regressor (or a MultiOutputRegressor of them) flattened into NumPy arrays.
+    The nodes of every tree are concatenated, leaves point to themselves, so all samples walk all trees at
+    once with a few gathers per level. It beats sklearn for a few samples (no per call overhead) but not for
+    large batches. Predictions are the same as the sklearn model's: the samples are cast to
+    float32 before being compared to the split thresholds and the trees are summed in order, then averaged.
+    """
+    def __init__(self, roots, feature, threshold, left, right, value, n_trees_per_output):
+        self.roots = roots
+        self.feature = feature
+        self.threshold = threshold
+        self.left = left
+        self.right = right
+        self.value = value
+        # One forest per output for a MultiOutputRegressor, a single forest for all outputs otherwise
+        self.n_trees_per_output = n_trees_per_output
+        # Laid out for the walk: the next node is children[2 * node + go_right]
+        self._feature = feature.astype(np.int32)
+        self._children = np.stack([left, right], axis=1).ravel().astype(np.int32)
+        self._is_leaf = left == np.arange(len(left))
+
+    @classmethod
+    def from_sklearn(cls, clf):
+        if hasattr(clf, 'estimators_') and all(hasattr(e, 'estimators_') for e in clf.estimators_):
+            # MultiOutputRegressor, each output is predicted by its own forest
+            forests = clf.estimators_
+        elif hasattr(clf, 'estimators_') and all(hasattr(e, 'tree_') for e in clf.estimators_):
+            forests = [clf]
+        else:
+            raise TypeError(f'Cannot export a {type(clf).__name__}, only random forest regressors are supported')
+
+        roots, feature, threshold, left, right, value = [], [], [], [], [], []
+        offset = 0
+        for forest in forests:
+            for estimator in forest.estimators_:
+                tree = estimator.tree_
+                is_leaf = tree.children_left == -1
+                nodes = np.arange(tree.node_count)
+                roots.append(offset)
+                feature.append(np.where(is_leaf, 0, tree.feature))
+                threshold.append(tree.threshold)
+                left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+                right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+                value.append(tree.value[:, :, 0])
+                offset += tree.node_count
+
+        return cls(
+            roots=np.array(roots, dtype=np.int64),
+            feature=np.concatenate(feature).astype(np.int64),
+            threshold=np.concatenate(threshold),
+            left=np.concatenate(left).astype(np.int64),
+            right=np.concatenate(right).astype(np.int64),
+            value=np.concatenate(value),
+            n_trees_per_output=np.array([len(f.estimators_) for f in forests], dtype=np.int64),
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            return cls(**{name: arrays[name] for name in arrays.files})
+
+    def save(self, path):
+        np.savez_compressed(path, roots=self.roots, feature=self.feature, threshold=self.threshold,
+                            left=self.left, right=self.right, value=self.value, n_trees_per_output=self.n_trees_per_output)
+
+    def predict(self, X):
+        X = np.ascontiguousarray(np.asarray(X), dtype=np.float32)
+        n_samples, n_features = X.shape
+        n_trees = len(self.roots)
+        # The feature a walk compares is at its sample's row offset + feature in the flattened samples
+        values = X.ravel()
+        feature, children, is_leaf = self._feature, self._children, self._is_leaf
+
+        # Walk every tree for every sample, a few levels at a time between dropping the walks which reached a leaf
+        # (the walks of a leaf stay on it, so the extra levels don't change anything)
+        node = np.tile(self.roots.astype(np.int32), n_samples)
+        active = np.arange(len(node))
+        current = node.copy()
+        index_dtype = np.int32 if X.size < 2 ** 31 else np.int64
+        offset = np.repeat(np.arange(n_samples, dtype=index_dtype) * n_features, n_trees)
+        while len(active):
+            for _ in range(WALK_LEVELS):
+                go_right = ~(values[offset + feature[current]] <= self.threshold[current])
+                current = children[2 * current + go_right]
+            node[active] = current
+            walking = ~is_leaf[current]
+            active, current, offset = active[walking], current[walking], offset[walking]
+
+        # Tree major, so each tree's leaf values are contiguous when they're summed
+        leaf_values = self.value[node.reshape(n_samples, n_trees).T]
+        if len(self.n_trees_per_output) == 1:
+            # A single forest predicting all of the outputs
+            return _average_trees(leaf_values)
+        # A forest per output, each predicting a single value
+        bounds = np.cumsum(np.concatenate([[0], self.n_trees_per_output]))
+        return np.stack([_average_trees(leaf_values[start:stop, :, 0]) for start, stop in zip(bounds[:-1], bounds[1:])], axis=1)
+
+
+def _average_trees(leaf_values):
+    # Sum the trees (leaf_values is trees x samples x ...) one at a time in order (as sklearn does) so the result is
+    # bit for bit the same
+    out = np.zeros(leaf_values.shape[1:])
+    for tree_values in leaf_values:
+        out += tree_values
+    out /= leaf_values.shape[0]
+    return out
+
+
+def load_sklearn_model():
+    # perhaps replace this with something such as skops to be more secure! \
+        # https://scikit-learn.org/stable/model_persistence.html#security-maintainability-limitations
+    with open(MODEL_PATH, 'rb') as f:
+        return pickle.load(f)
+
+
+@lru_cache(maxsize=None)
+def get_exported_model():
+    return FlatForest.load(EXPORTED_MODEL_PATH)
+
+
+@lru_cache(maxsize=None)
+def get_sklearn_model():
+    return load_sklearn_model()
+
+
+def get_model(n_samples=1):
+    # The exported forest is faster for a few histograms (and starts up without sklearn), sklearn's compiled tree walk
+    # is faster for large batches, so with 'auto' batches of more than FLAT_BATCH_LIMIT go to sklearn
+    if MODEL_FORMAT == 'exported':
+        return get_exported_model()
+    if MODEL_FORMAT == 'auto' and EXPORTED_MODEL_PATH.exists() and (n_samples <= FLAT_BATCH_LIMIT or not MODEL_PATH.exists()):
+        return get_exported_model()
+    return get_sklearn_model()
+
+
+def predict(histograms: np.ndarray) -> np.ndarray:
+    # Predicts (tmin, tmax) for each row of a N x 256 matrix of normalized histograms
+    histograms = np.atleast_2d(histograms)
+    return get_model(len(histograms)).predict(histograms)
+
+
+def export_model(path=EXPORTED_MODEL_PATH):
+    # Flattens the pickled sklearn model to arrays, which are used in its place from then on
+    FlatForest.from_sklearn(load_sklearn_model()).save(path)
+
+
+if __name__ == '__main__':
+    # python ace_model.py export [path]
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        export_model(sys.argv[2] if len(sys.argv) > 2 else EXPORTED_MODEL_PATH)
@@ -53,14 +53,17 @@ class AceWSI(TechnicalVarianceCorrection,Automated):
         
         temp = WholeSlideImage()
 
-        for channel_name, channel in input.data.whole_slide_image.items():
-
-            new_im, thresholds = ace.fastACE(channel.read())
-            temp[channel_name] = WholeSlideImageProteinChannel.write(
+        # Histograms of all channels are classified in one batch, the channels are then adjusted and written concurrently
+        written = ace.batch_ACE(
+            input.data.whole_slide_image,
+            lambda channel_name, new_im: WholeSlideImageProteinChannel.write(
                     data=new_im,
                     prefix=prefix,
-                    file_name=channel_name)
-        
+                    file_name=channel_name))
+
+        for channel_name, channel in written.items():
+            temp[channel_name] = channel
+
 
         return AceWSIProcessOutput(
             data=AceWSIProcessOutput.Data(
@@ -0,0 +1,93 @@
+# Benchmark for the ACE threshold regressor served by ace_model
+# Times the start up (import and model load, in a fresh interpreter) and the predict latency of the pickled
+# sklearn model against the exported flat tree arrays, one channel per call and batched (with the batch sizes
+# either side of ACE_FLAT_BATCH_LIMIT, above which 'auto' hands batches to sklearn), and checks the two predict
+# exactly the same thresholds
+#
+# Run from the service root: python tests/benchmarks/bench_ace_model.py [n_channels]
+# Uses app/models/ace_clf.pkl if present, otherwise a random forest of a similar size trained on synthetic histograms
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+APP_DIR = Path(__file__).resolve().parents[2] / 'app'
+sys.path.insert(0, str(APP_DIR))
+import ace_model #type: ignore
+
+
+def synthetic_histograms(n, rng):
+    # Gamma shaped intensity distributions, like those of the protein channels
+    samples = rng.gamma(2, rng.uniform(5, 60, (n, 1)), (n, 4096)).clip(0, 255).astype(np.uint8)
+    hist = np.stack([np.bincount(s, minlength=256) for s in samples]).astype(np.float64)
+    return hist / hist.sum(axis=1, keepdims=True)
+
+
+def synthetic_model(path, rng):
+    from sklearn.ensemble import RandomForestRegressor
+    import pickle
+    X = synthetic_histograms(500, rng)
+    y = np.c_[rng.integers(0, 60, len(X)), rng.integers(120, 255, len(X))]
+    with open(path, 'wb') as f:
+        pickle.dump(RandomForestRegressor(n_estimators=100, random_state=0).fit(X, y), f)
+
+
+def startup_time(model_path, exported_path, model_format):
+    # Import and first prediction in a fresh interpreter, as at container start up
+    code = (
+        'import time; start = time.perf_counter(); import sys; sys.path.insert(0, sys.argv[1]); import ace_model, numpy as np; '
+        'ace_model.MODEL_PATH, ace_model.EXPORTED_MODEL_PATH, ace_model.MODEL_FORMAT = sys.argv[2], sys.argv[3], sys.argv[4]; '
+        'ace_model.predict(np.full(256, 1 / 256)); print(time.perf_counter() - start)'
+    )
+    out = subprocess.run([sys.executable, '-c', code, str(APP_DIR), str(model_path), str(exported_path), model_format], capture_output=True, text=True, check=True)
+    return float(out.stdout)
+
+
+def timed(f):
+    start = time.perf_counter()
+    result = f()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    n_channels = int(sys.argv[1]) if len(sys.argv) > 1 else 60 * 150
+    rng = np.random.default_rng(0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        model_path = ace_model.MODEL_PATH
+        if not model_path.exists():
+            model_path = Path(tmp) / 'ace_clf.pkl'
+            synthetic_model(model_path, rng)
+        exported_path = Path(tmp) / 'ace_clf.npz'
+        ace_model.MODEL_PATH = model_path
+        ace_model.export_model(exported_path)
+
+        sklearn_model = ace_model.load_sklearn_model()
+        flat_model = ace_model.FlatForest.load(exported_path)
+        histograms = synthetic_histograms(n_channels, rng)
+
+        sklearn_start = startup_time(model_path, exported_path, 'sklearn')
+        flat_start = startup_time(model_path, exported_path, 'exported')
+
+        single = histograms[:min(n_channels, 200)]
+        _, sklearn_single = timed(lambda: [sklearn_model.predict(h.reshape(1, -1)) for h in single])
+        _, flat_single = timed(lambda: [flat_model.predict(h.reshape(1, -1)) for h in single])
+        sklearn_batch, sklearn_batched = timed(lambda: sklearn_model.predict(histograms))
+        flat_batch, flat_batched = timed(lambda: flat_model.predict(histograms))
+        batch_sizes = sorted({size for size in (64, 256, ace_model.FLAT_BATCH_LIMIT, 2048) if size <= n_channels})
+        by_size = [(size, timed(lambda: sklearn_model.predict(histograms[:size]))[1], timed(lambda: flat_model.predict(histograms[:size]))[1])
+                   for size in batch_sizes]
+
+    np.testing.assert_array_equal(flat_batch, sklearn_batch)
+
+    print(f'{n_channels} channels')
+    print(f'start up (import, load, first predict): sklearn {sklearn_start:.3f}s, exported {flat_start:.3f}s')
+    print(f'predict, one channel per call:          sklearn {1000 * sklearn_single / len(single):.2f}ms, exported {1000 * flat_single / len(single):.2f}ms per channel')
+    print(f'predict, all channels in one call:      sklearn {sklearn_batched:.3f}s, exported {flat_batched:.3f}s')
+    for size, sklearn_time, flat_time in by_size:
+        print(f'predict, batches of {size:<5}                sklearn {1000 * sklearn_time:.1f}ms, exported {1000 * flat_time:.1f}ms')
+    print(f"with ACE_MODEL_FORMAT=auto, batches of more than {ace_model.FLAT_BATCH_LIMIT} go to sklearn")
+    print('predictions identical')
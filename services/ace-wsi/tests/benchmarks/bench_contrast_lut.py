@@ -0,0 +1,63 @@
+# Benchmark for the contrast stretching applied by ace.fastACE
+# Compares the original per-pixel np.vectorize implementation against the lookup table one
+# and checks the two produce byte identical images for a range of thresholds
+#
+# Run from the service root: python tests/benchmarks/bench_contrast_lut.py [image_size]
+# The per-pixel implementation is timed on a crop of the image (and extrapolated), as it takes minutes on a full WSI channel
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = None
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'app'))
+import ace #type: ignore
+
+LEGACY_CROP = 2048
+
+
+# The original implementation, kept here as the reference the lookup table is checked against
+def legacy_contrast_function_8bit(img, min, max):
+    output_min, output_max = 0,255
+
+    def rescale_pixel(px):
+        if px <= min:
+            return output_min
+        elif px > max:
+            return output_max
+        else:
+            return np.uint8((((px - min) / max) * output_max))
+
+    vect_func = np.vectorize(rescale_pixel)
+
+    return Image.fromarray(np.uint8(vect_func(np.array(img))))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    rng = np.random.default_rng(0)
+
+    # Every pixel value appears in the correctness check, thresholds cover the edge cases of the mapping
+    check = Image.fromarray(np.arange(256 * 64, dtype=np.uint16).reshape(128, 128).astype(np.uint8))
+    for tmin, tmax in [(0, 255), (10, 200), (-20, 180), (100, 100), (150, 50), (0, 1), (254, 255)]:
+        assert np.array_equal(np.array(ace.contrast_function_8bit(check, tmin, tmax)), np.array(legacy_contrast_function_8bit(check, tmin, tmax))), (tmin, tmax)
+
+    img = Image.fromarray(rng.integers(0, 256, (size, size), dtype=np.uint8))
+    crop = img.crop((0, 0, min(size, LEGACY_CROP), min(size, LEGACY_CROP)))
+    print(f'{size}x{size} image')
+
+    start = time.perf_counter()
+    legacy = legacy_contrast_function_8bit(crop, 10, 200)
+    legacy_time = (time.perf_counter() - start) * (size * size) / (crop.size[0] * crop.size[1])
+
+    start = time.perf_counter()
+    out = ace.contrast_function_8bit(img, 10, 200)
+    lut_time = time.perf_counter() - start
+
+    assert np.array_equal(np.array(out.crop((0, 0) + crop.size)), np.array(legacy))
+
+    print(f'per-pixel contrast stretching: {legacy_time:.2f}s' + (' (extrapolated)' if crop.size != img.size else ''))
+    print(f'lookup table contrast stretching: {lut_time:.2f}s ({legacy_time / lut_time:.0f}x)')
+    print('outputs identical')
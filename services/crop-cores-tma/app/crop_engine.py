@@ -0,0 +1,113 @@
+# Cropping of the cores out of the TMA channels with window reads
+# Only the tiles / strips of a channel which intersect a core are fetched and decoded, the gaps between the cores
+# never are, and only one core per channel is held in memory at a time. Channels are cropped in parallel
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+from PIL import Image
+
+from image_utils import coordinate_translation #type: ignore
+import pyramid #type: ignore
+
+# Number of channels cropped concurrently
+CROP_WORKERS = int(os.getenv('CROP_WORKERS', min(8, os.cpu_count() or 1)))
+# Segments closer together in the file than this are fetched with a single read
+COALESCE_GAP = 1 << 20
+
+
+def segment_grid(page):
+    # Height and width of the strips / tiles the page is stored in, and the number of segments across
+    if page.is_tiled:
+        seg_h, seg_w = page.tilelength, page.tilewidth
+    else:
+        seg_h, seg_w = min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+    return seg_h, seg_w, -(-page.imagewidth // seg_w)
+
+
+def aligned_window(page, bounds):
+    # The segment aligned window covering bounds (left, top, right, bottom) clipped to the image,
+    # as the indices of the segments it's made of, or None if bounds doesn't overlap the image
+    left, top, right, bottom = bounds
+    row_start, row_stop = max(top, 0), min(bottom, page.imagelength)
+    col_start, col_stop = max(left, 0), min(right, page.imagewidth)
+    if row_start >= row_stop or col_start >= col_stop:
+        return None
+    seg_h, seg_w, segments_across = segment_grid(page)
+    return [
+        seg_row * segments_across + seg_col
+        for seg_row in range(row_start // seg_h, (row_stop - 1) // seg_h + 1)
+        for seg_col in range(col_start // seg_w, (col_stop - 1) // seg_w + 1)
+    ]
+
+
+def read_segments(page, indices):
+    # Raw bytes of the given segments, segments which are close together in the file are fetched with one read
+    fh = page.parent.filehandle
+    order = sorted((i for i in indices if page.databytecounts[i] > 0), key=lambda i: page.dataoffsets[i])
+    data = {}
+    start = 0
+    while start < len(order):
+        stop = start + 1
+        while stop < len(order) and page.dataoffsets[order[stop]] - (page.dataoffsets[order[stop - 1]] + page.databytecounts[order[stop - 1]]) < COALESCE_GAP:
+            stop += 1
+        first = page.dataoffsets[order[start]]
+        last = page.dataoffsets[order[stop - 1]] + page.databytecounts[order[stop - 1]]
+        with fh.lock:
+            fh.seek(first)
+            chunk = fh.read(last - first)
+        for i in order[start:stop]:
+            data[i] = chunk[page.dataoffsets[i] - first:page.dataoffsets[i] - first + page.databytecounts[i]]
+        start = stop
+    return data
+
+
+def crop(page, bounds):
+    # The same as PIL's crop(bounds) of the page, areas outside of the image are zero filled
+    left, top, right, bottom = bounds
+    out = np.zeros((bottom - top, right - left), dtype=page.dtype)
+    indices = aligned_window(page, bounds)
+    if indices is None:
+        return Image.fromarray(out)
+    for index, data in read_segments(page, indices).items():
+        segment, (_, _, seg_top, seg_left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+        if segment is None:
+            # Empty segments are implicitly zero
+            continue
+        segment = segment[0, :, :, 0]
+        # Intersect the segment with the core (and the image, as edge tiles are padded)
+        r0, r1 = max(seg_top, top, 0), min(seg_top + segment.shape[0], bottom, page.imagelength)
+        c0, c1 = max(seg_left, left, 0), min(seg_left + segment.shape[1], right, page.imagewidth)
+        if r0 < r1 and c0 < c1:
+            out[r0 - top:r1 - top, c0 - left:c1 - left] = segment[r0 - seg_top:r1 - seg_top, c0 - seg_left:c1 - seg_left]
+    return Image.fromarray(out)
+
+
+def crop_channel(channel, rois, write):
+    # Crops every roi out of one channel, write(core_index, image) stores each core as soon as it's cropped
+    with pyramid.open_channel(channel) as tf:
+        page = pyramid.levels(tf)[0]
+        written = []
+        for i, roi in enumerate(rois):
+            # Translate to coordinates from the image they were predicted/draw on to the full size image
+            bounds = coordinate_translation(roi.img_w,
+                                            page.imagewidth,
+                                            roi.img_h,
+                                            page.imagelength,
+                                            roi.x1,
+                                            roi.y1,
+                                            roi.x2,
+                                            roi.y2)
+            written.append(write(i, crop(page, bounds)))
+        return written
+
+
+def crop_cores(channels: dict, rois, write, workers=CROP_WORKERS) -> dict:
+    # Crops the rois out of every channel, write(channel_name, core_index, image) is called for each core
+    # Returns {channel_name: [written core for each roi]}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            channel_name: executor.submit(crop_channel, channel, rois, lambda i, image, channel_name=channel_name: write(channel_name, i, image))
+            for channel_name, channel in channels.items()
+        }
+        return {channel_name: future.result() for channel_name, future in futures.items()}
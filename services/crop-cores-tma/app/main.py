@@ -3,7 +3,7 @@ from enum import Enum
 from cdb_cellmaps.data import DearrayedTissueMicroArray, RegionsOfInterest, TissueCore, TissueCoreProteinChannel, TissueMicroArray
 from cdb_cellmaps import data_utils
 from cdb_cellmaps.process import Automated, DeArray
-from image_utils import coordinate_translation #type: ignore
+from crop_engine import crop_cores #type: ignore
 
 
 @dataclass
@@ -48,32 +48,28 @@ class CropCoresTMA(DeArray,Automated):
         return data_utils.decode_dict(data_class=CropCoresTMAProcessInput,data=body)
     def process(self, prefix, input: CropCoresTMAProcessInput) -> CropCoresTMAProcessOutput:
         temp = DearrayedTissueMicroArray()
-        for channel_name,channel in input.data.tissue_micro_array.items():
-            # Load in full channel
-            tiff = channel.read()
+        # This will iterate correctly, but need to figure out how to retain type annotations for objects
+        # being iterated over
+        rois = list(input.workflow_parameters.rois)
+        channels = dict(input.data.tissue_micro_array.items())
 
-            # This will iterate correctly, but need to figure out how to retain type annotations for objects
-            # being iterated over
-            for i,roi in enumerate(input.workflow_parameters.rois):
-                # Translate to coordinates from the image they were predicted/draw on to the full size image
-                bounds = coordinate_translation(roi.img_w, 
-                                             tiff.width, 
-                                             roi.img_h, 
-                                             tiff.height, 
-                                             roi.x1,
-                                             roi.y1,
-                                             roi.x2,
-                                             roi.y2)
-                core_name = f'A{i}'
-                if core_name not in temp.keys():
-                    temp[core_name] = TissueCore()
-                # Change Prefix
-                temp[core_name][channel_name] = TissueCoreProteinChannel.write(
-                    data=tiff.crop(bounds), 
-                    prefix=prefix.add_level(
-                        level=core_name),
-                        file_name=channel_name
-                        )
+        # Only the tiles which intersect the cores are decoded, the cores of all the channels are written in parallel
+        cores = crop_cores(
+            channels,
+            rois,
+            # Change Prefix
+            lambda channel_name, i, core: TissueCoreProteinChannel.write(
+                data=core,
+                prefix=prefix.add_level(
+                    level=f'A{i}'),
+                    file_name=channel_name
+                    ))
+
+        for i, _ in enumerate(rois):
+            temp[f'A{i}'] = TissueCore()
+        for channel_name, channel_cores in cores.items():
+            for i, core in enumerate(channel_cores):
+                temp[f'A{i}'][channel_name] = core
         return CropCoresTMAProcessOutput(
             data=CropCoresTMAProcessOutput.Data(
                 dearrayed_tissue_micro_array=temp
@@ -0,0 +1,82 @@
+# Per core checkpoints, so a job which is retried carries on from the core it failed on rather than starting again
+# The masks written for each finished core are recorded in a manifest, which is stored after every core. The job's
+# prefix carries the time it was started, so differs between attempts, the manifest is instead found by workflow
+# and job id. Masks recorded by an earlier attempt stay where that attempt wrote them
+import io
+import json
+import logging
+import os
+import threading
+
+from cdb_cellmaps._config import Config as _Config
+
+# 'True' to record finished cores and skip them when the job is retried
+CHECKPOINTS = os.getenv('DEEPCELL_CHECKPOINTS', 'True') == 'True'
+
+
+class Manifest():
+    """
+    The encoded outputs of the finished cores of a job, {core_name: encoded output}. Stored as json in the workflow
+    bucket (locally in debug, in the same place cls.write would put it), under {workflow_id}/checkpoints/.
+    """
+    def __init__(self, prefix, routing_key, job_id=None):
+        workflow_id = prefix.split('/')[0]
+        job_id = job_id or os.getenv('CINCODEBIO_JOB_ID')
+        self.object_name = f'{workflow_id}/checkpoints/{routing_key}-{job_id}.json'
+        self.entries = self._load() if CHECKPOINTS else {}
+        self._lock = threading.Lock()
+        if self.entries:
+            logging.warning(f'Resuming, {len(self.entries)} core(s) already finished ({self.object_name})')
+
+    def __contains__(self, core_name):
+        return core_name in self.entries
+
+    def __getitem__(self, core_name):
+        return self.entries[core_name]
+
+    def record(self, core_name, encoded):
+        if not CHECKPOINTS:
+            return
+        with self._lock:
+            self.entries[core_name] = encoded
+            self._save(json.dumps(self.entries).encode())
+
+    def _load(self):
+        if _Config.DEBUG():
+            try:
+                with open(self.object_name[1:]) as f:
+                    return json.load(f)
+            except FileNotFoundError:
+                return {}
+
+        from cdb_cellmaps._utils import get_minio_client
+        from minio.error import S3Error
+        try:
+            response = get_minio_client().get_object(_Config._MINIO_WORKFLOW_BUCKET, self.object_name)
+        except S3Error as e:
+            if e.code == 'NoSuchKey':
+                return {}
+            raise
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+            response.release_conn()
+
+    def _save(self, data):
+        if _Config.DEBUG():
+            path = self.object_name[1:]
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Replace the manifest in one step, so a failure mid write can't leave it truncated
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+            return
+
+        from cdb_cellmaps._utils import get_minio_client
+        get_minio_client().put_object(
+            _Config._MINIO_WORKFLOW_BUCKET,
+            self.object_name,
+            io.BytesIO(data),
+            len(data),
+            content_type='application/json')
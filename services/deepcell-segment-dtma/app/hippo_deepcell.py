@@ -1,10 +1,14 @@
 from deepcell_toolbox.utils import tile_image     
-from deepcell_toolbox.utils import untile_image, erode_edges
+from deepcell_toolbox.utils import untile_image
 from deepcell.applications import Mesmer
 from skimage.measure import label, regionprops, regionprops_table
 from scipy.ndimage import distance_transform_edt
+from scipy.sparse import coo_matrix
 from skimage.segmentation import expand_labels
 import tensorflow as tf
+import logging
+import threading
+import time
 
 
 import pandas as pd
@@ -20,36 +24,173 @@ Image.MAX_IMAGE_PIXELS = None
 
 MODEL_PATH = f'{os.path.dirname(os.path.abspath(__file__))}/MultiplexSegmentation'
 
+# Potentially make these as input variables
+TILE_SIZE = 256
+MICRONS_PER_PIX = 0.5
+ERODE_WIDTH = 1
+BATCH_SIZE = int(os.getenv('DEEPCELL_BATCH_SIZE', 4))
+# Tiles (from any number of cores) queued before they're predicted together, a multiple of BATCH_SIZE keeps the batches full
+INFERENCE_CHUNK_TILES = int(os.getenv('DEEPCELL_CHUNK_TILES', 16 * BATCH_SIZE))
+# Labels are expanded a window of this size (plus a halo of the expansion distance) at a time
+EXPAND_TILE_SIZE = int(os.getenv('DEEPCELL_EXPAND_TILE_SIZE', 1024))
+# How the model is run: 'keras' (model.predict), 'xla' (a traced tf.function compiled with XLA) or 'frozen' (the
+# model's graph with its variables frozen to constants)
+INFERENCE_BACKEND = os.getenv('DEEPCELL_INFERENCE_BACKEND', 'keras')
+# Sizes of TensorFlow's thread pools, 0 leaves them to TensorFlow (one thread per core)
+INTRA_OP_THREADS = int(os.getenv('DEEPCELL_INTRA_OP_THREADS', 0))
+INTER_OP_THREADS = int(os.getenv('DEEPCELL_INTER_OP_THREADS', 0))
+
+# The thread pools can only be configured before TensorFlow's runtime starts, if it already has (e.g. something
+# imported before this module ran an op) the settings are ignored with a warning rather than failing the import
+try:
+    if INTRA_OP_THREADS:
+        tf.config.threading.set_intra_op_parallelism_threads(INTRA_OP_THREADS)
+    if INTER_OP_THREADS:
+        tf.config.threading.set_inter_op_parallelism_threads(INTER_OP_THREADS)
+except RuntimeError as e:
+    logging.warning(f'TensorFlow thread pools not configured (intra op {INTRA_OP_THREADS}, inter op {INTER_OP_THREADS}): {e}')
+
+# The Mesmer app is loaded once per process and reused for every core (and every job) the process handles
+_PROCESS_START = time.perf_counter()
+_mesmer_app = None
+_mesmer_lock = threading.Lock()
+
+
+class GraphModel():
+    """
+    Stands in for the Keras model inside the Mesmer app, running each batch through a compiled function rather
+    than model.predict. Everything else (e.g. the input shape Mesmer reads) is the Keras model's.
+    """
+    def __init__(self, model, backend):
+        self.model = model
+        spec = tf.TensorSpec([None, *model.input_shape[1:]], model.inputs[0].dtype)
+        if backend == 'xla':
+            self.fn = tf.function(lambda x: model(x, training=False), input_signature=[spec], jit_compile=True)
+        elif backend == 'frozen':
+            from tensorflow.python.framework.convert_to_constants import convert_variables_to_constants_v2
+            self.fn = convert_variables_to_constants_v2(tf.function(lambda x: model(x, training=False)).get_concrete_function(spec))
+        else:
+            raise ValueError(f'Unknown inference backend {backend}, use keras, xla or frozen')
+
+    def __getattr__(self, name):
+        return getattr(self.model, name)
+
+    def predict(self, x, batch_size=BATCH_SIZE, **kwargs):
+        # The same as model.predict, a list with an array per model output
+        outputs = []
+        for start in range(0, len(x), batch_size):
+            batch = tf.convert_to_tensor(x[start:start + batch_size], dtype=self.model.inputs[0].dtype)
+            outputs.append([o.numpy() for o in tf.nest.flatten(self.fn(batch))])
+        outputs = [np.concatenate(parts) for parts in zip(*outputs)]
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+def load_mesmer_app(backend=INFERENCE_BACKEND) -> Mesmer:
+    model = tf.keras.models.load_model(MODEL_PATH)
+    app = Mesmer(model)
+    if backend != 'keras':
+        app.model = GraphModel(model, backend)
+    return app
+
+
+def get_mesmer_app() -> Mesmer:
+    global _mesmer_app
+    with _mesmer_lock:
+        if _mesmer_app is None:
+            start = time.perf_counter()
+            app = load_mesmer_app()
+            loaded = time.perf_counter()
+            # Warm up with a dummy batch, so the graph is traced before the first core rather than during it
+            app.predict(np.zeros((BATCH_SIZE, TILE_SIZE, TILE_SIZE, 2), dtype=np.float32), image_mpp = MICRONS_PER_PIX, compartment = 'both', batch_size = BATCH_SIZE)
+            warmed = time.perf_counter()
+            logging.warning(f'Mesmer ({INFERENCE_BACKEND}) ready {warmed - _PROCESS_START:.2f}s after start up (load: {loaded - start:.2f}s, warm up: {warmed - loaded:.2f}s)')
+            _mesmer_app = app
+        return _mesmer_app
+
+
 def segment_core(nucelus_img, membrane_img):
+    tiles, tile_info = prepare_core(nucelus_img, membrane_img)
+    return postprocess_core(predict_tiles(tiles), tile_info)
+
+
+class TileBatcher():
+    """
+    Packs the tiles of consecutive cores into full prediction batches. Tiles are queued until at least
+    chunk_tiles are waiting, then the whole batches among them are predicted in one stream, the remaining tiles
+    wait for the next core's tiles to fill their batch. Predictions are routed back to the cores they came from,
+    a core is returned (core_name, predictions, tile_info) once all of its tiles have been predicted.
+    """
+    def __init__(self, chunk_tiles=None, batch_size=BATCH_SIZE):
+        # At least one batch is queued before predicting, so every prediction (but the last) fills whole batches
+        self.chunk_tiles = max(chunk_tiles or INFERENCE_CHUNK_TILES, batch_size)
+        self.batch_size = batch_size
+        self.pending = []  # [core_name, tile_info, number of tiles, [predictions]] in the order their tiles were queued
+        self.queue = []
+
+    def add(self, core_name, tiles, tile_info):
+        self.pending.append([core_name, tile_info, len(tiles), []])
+        self.queue.append(tiles)
+        n_queued = sum(len(t) for t in self.queue)
+        if n_queued < self.chunk_tiles:
+            return []
+        self._predict_queue(n_queued - n_queued % self.batch_size)
+        return self._finished_cores()
+
+    def flush(self):
+        # Predict whatever is left (the last batch may be partial)
+        if self.queue:
+            self._predict_queue(sum(len(t) for t in self.queue))
+        return self._finished_cores()
+
+    def _predict_queue(self, n_tiles):
+        tiles = np.concatenate(self.queue)
+        self.queue = [tiles[n_tiles:]] if n_tiles < len(tiles) else []
+        predictions = predict_tiles(tiles[:n_tiles])
+        offset = 0
+        for core in self.pending:
+            take = min(core[2] - sum(len(p) for p in core[3]), len(predictions) - offset)
+            if take > 0:
+                core[3].append(predictions[offset:offset + take])
+                offset += take
+
+    def _finished_cores(self):
+        finished = []
+        while self.pending and sum(len(p) for p in self.pending[0][3]) == self.pending[0][2]:
+            core_name, tile_info, _, predictions = self.pending.pop(0)
+            finished.append((core_name, np.concatenate(predictions), tile_info))
+        return finished
+
+
+def prepare_core(nucelus_img, membrane_img):
     assert type(nucelus_img) == TiffImagePlugin.TiffImageFile or type(nucelus_img) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(nucelus_img)}'
     assert type(membrane_img) == TiffImagePlugin.TiffImageFile or type(membrane_img) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(membrane_img)}'
-    # Loading the deepcell model
-    app = Mesmer(tf.keras.models.load_model(MODEL_PATH))
-    # Potentially make these as input variables
-    TILE_SIZE = 256
-    MICRONS_PER_PIX = 0.5
-    ERODE_WIDTH = 1
-    BATCH_SIZE = 4
     # Create array structure for segmentation model [1, ncol, nrow, nchannels]
     deepcell_input = np.expand_dims(np.stack([np.array(nucelus_img),np.array(membrane_img)],axis=2),axis=0)
-    tiles,tile_info = tile_image(deepcell_input, model_input_shape=(TILE_SIZE,TILE_SIZE)) # is this the main issue for RAM? Make sure the image is uint8 so dtype within np.zeros is uint8
-    segmentation_predictions = app.predict(tiles, image_mpp = MICRONS_PER_PIX, compartment = 'both', batch_size = BATCH_SIZE)
-    #segmentation_eroded = segmentation_predictions # is this the best way to do this memory wise?
-    for i in range(0,segmentation_predictions.shape[0]):
-        segmentation_predictions[i,...,0] = erode_edges(segmentation_predictions[i,...,0], ERODE_WIDTH)
-        segmentation_predictions[i,...,1] = erode_edges(segmentation_predictions[i,...,1], ERODE_WIDTH)
+    return tile_image(deepcell_input, model_input_shape=(TILE_SIZE,TILE_SIZE)) # is this the main issue for RAM? Make sure the image is uint8 so dtype within np.zeros is uint8
+
+
+def predict_tiles(tiles):
+    # The deepcell model (cached for the life of the process)
+    # Mesmer pre / post processes every tile on its own, so the tiles can come from any number of cores
+    app = get_mesmer_app()
+    return app.predict(tiles, image_mpp = MICRONS_PER_PIX, compartment = 'both', batch_size = BATCH_SIZE)
+
+
+def postprocess_core(segmentation_predictions, tile_info):
+    # Erode every tile of both compartments at once, in place (the predictions aren't used for anything else)
+    erode_edges_batch(segmentation_predictions, ERODE_WIDTH)
     segmentation_eroded_whole = untile_image(segmentation_predictions, tile_info)
     
     del segmentation_predictions, tile_info
     
-    segmentation_eroded_whole[0,...,0][segmentation_eroded_whole[0,...,0] > 0] = 1
-    segmentation_eroded_whole[0,...,1][segmentation_eroded_whole[0,...,1] > 0] = 1
+    # Binarize both compartments in place, labels > 0 become 1
+    np.minimum(segmentation_eroded_whole, 1, out=segmentation_eroded_whole)
     labeled_eroded = segmentation_eroded_whole
     #labeled_eroded[0,...,0] = label(segmentation_eroded_whole[0,...,0]) # membrane
     #labeled_eroded[0,...,1] = label(segmentation_eroded_whole[0,...,1]) # nucleus
     # This could simply be replaced by skimage.segmentation expand_labels
-    labeled_eroded[0,...,0] = expandLabelsHIPPo(label(segmentation_eroded_whole[0,...,0]), distance = ERODE_WIDTH) # membrane
-    labeled_eroded[0,...,1] = expandLabelsHIPPo(label(segmentation_eroded_whole[0,...,1]), distance = ERODE_WIDTH) # nucleus
+    labeled_eroded[0,...,0] = expand_labels_tiled(label(segmentation_eroded_whole[0,...,0]), distance = ERODE_WIDTH) # membrane
+    labeled_eroded[0,...,1] = expand_labels_tiled(label(segmentation_eroded_whole[0,...,1]), distance = ERODE_WIDTH) # nucleus
     
     nucleus_mask, membrane_mask_precorrection = Image.fromarray(labeled_eroded[0,...,1].astype(np.uint32)), Image.fromarray(labeled_eroded[0,...,0].astype(np.uint32))
         
@@ -57,6 +198,26 @@ def segment_core(nucelus_img, membrane_img):
     return nucleus_mask, match_labels_and_correct(nucleus_mask,membrane_mask_precorrection)
 
         
+def erode_edges_batch(masks, erosion_width):
+    # erode_edges of every tile and compartment of a (tiles, rows, cols, compartments) stack at once, in place
+    # Each step zeroes the inner boundaries (find_boundaries with mode='inner'): labelled pixels with a different
+    # value among their 4 neighbours within the tile. Pixels beyond the tile's edge count as equal (reflected edges)
+    boundaries = np.empty(masks.shape, dtype=bool)
+    changed = np.empty((masks.shape[0], max(masks.shape[1:3]), max(masks.shape[1:3]), masks.shape[3]), dtype=bool)
+    for _ in range(erosion_width):
+        boundaries[:] = False
+        # Differences between vertical neighbours mark both pixels, then the same for horizontal neighbours
+        rows = np.not_equal(masks[:, 1:], masks[:, :-1], out=changed[:, :masks.shape[1] - 1, :masks.shape[2]])
+        boundaries[:, 1:] |= rows
+        boundaries[:, :-1] |= rows
+        cols = np.not_equal(masks[:, :, 1:], masks[:, :, :-1], out=changed[:, :masks.shape[1], :masks.shape[2] - 1])
+        boundaries[:, :, 1:] |= cols
+        boundaries[:, :, :-1] |= cols
+        boundaries &= masks != 0
+        masks[boundaries] = 0
+    return masks
+
+
 def expandLabelsHIPPo(label_image, distance=1):
     # from scipy.ndimage import distance_transform_edt
     '''
@@ -88,6 +249,26 @@ def expandLabelsHIPPo(label_image, distance=1):
     return labels_out
 
 
+def expand_labels_tiled(label_image, distance=1, tile_size=None):
+    # expandLabelsHIPPo applied window by window, so the distance transform's float distances and index arrays are
+    # the size of a window rather than the whole image. Each window is padded with a halo of the expansion
+    # distance, which holds every label a pixel of the window can be expanded from, so the result is the same
+    tile_size = tile_size or EXPAND_TILE_SIZE
+    halo = int(np.ceil(distance))
+    height, width = label_image.shape
+    labels_out = np.zeros_like(label_image)
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            r0, c0 = max(top - halo, 0), max(left - halo, 0)
+            window = label_image[r0:min(top + tile_size + halo, height), c0:min(left + tile_size + halo, width)]
+            if not window.any():
+                # Nothing to expand into the window
+                continue
+            expanded = expandLabelsHIPPo(window, distance=distance)
+            labels_out[top:top + tile_size, left:left + tile_size] = expanded[top - r0:top - r0 + tile_size, left - c0:left - c0 + tile_size]
+    return labels_out
+
+
 
 def match_labels_and_correct(nucleus_mask, membrane_mask):
     assert type(nucleus_mask) == TiffImagePlugin.TiffImageFile or type(nucleus_mask) == Image.Image, f'Please use a PIL.TiffImagePlugin.TiffImageFile, not {type(nucleus_mask)}'
@@ -95,84 +276,51 @@ def match_labels_and_correct(nucleus_mask, membrane_mask):
     # Convert PIL image to np array
     nucleus_array = np.array(nucleus_mask,dtype=np.uint32)
     membrane_array = np.array(membrane_mask,dtype=np.uint32)
-    # Get all the mask regions for both nucleus and membrane mask
-    nuc_regions = regionprops(nucleus_array); nuc_region_dict = {nr.label: nr for nr in nuc_regions}
-    mem_regions = regionprops(membrane_array); mem_regions_dict = {mr.label: mr for mr in mem_regions}
     
     # Creating blank arrays to copy membrane masks that are correct and incorrect into, Incorrect is defined as 1 membrane has > 1 nucleus who's maximum overlap is what that membrane
-    blank_membrane = np.zeros(membrane_array.shape,np.uint32)
-    blank_membrane_for_growth = np.zeros(membrane_array.shape,np.uint32)
-
     """
     How it works
     For a given Nucleus:
         Find the membrane it overlaps with the most
         For that membrane, find the nuclei it overlaps with
         For each of those nuclei - check if the membrane that it overlaps with most is the membrane
+    All of the overlaps are counted at once in a sparse nucleus x membrane contingency table,
+    every nucleus / membrane decision is then made with array operations on the table
     """
     
     # Phase 1, find the nuceli / membrane mask mismatches
     
-    for nuc_region in nuc_regions:
-        try:
-            # Get bounding box for the nucleus
-            col1, row1, col2, row2 = nuc_region.bbox
-            # Crop the section nucleus bounding box for both the nucleus and the membrane
-            nuc_subsection_nuc = nucleus_array[col1:col2,row1:row2]
-            mem_subsection_nuc = membrane_array[col1:col2,row1:row2]
-            # Using the nucleus label as a gate, find the maximum membrane overlap and remove background counts
-            mem_labels, mem_counts = np.unique(mem_subsection_nuc * (nuc_subsection_nuc == nuc_region.label),return_counts=True)
-            zeros = np.where(mem_labels==0)[0]
-            mem_labels, mem_counts = np.delete(mem_labels,zeros), np.delete(mem_counts, zeros)
-            # The maximum overlap is the one with the highest count
-            cm_id = mem_labels[np.argmax(mem_counts)]
-            # Get the maximum overlap membrane bounding box and crop both the nucleus and the membrane
-            cm = mem_regions_dict[cm_id]
-            mcol1,mrow1,mcol2,mrow2 = cm.bbox
-            nuc_subsection_mem = nucleus_array[mcol1:mcol2,mrow1:mrow2]
-            mem_subsection_mem = membrane_array[mcol1:mcol2,mrow1:mrow2]
-            # Get the set of nucleus labels
-            nuc_labels,nuc_counts = np.unique(nuc_subsection_mem * (mem_subsection_mem == cm_id),return_counts=True)
-            # Iterate over every nucleus label and find if the given membrane_id is the maximum overlap for it
-            zeros = np.where(nuc_labels==0)[0]
-            nuc_labels, nuc_counts = np.delete(nuc_labels, zeros), np.delete(nuc_counts, zeros)
-            nuclei_matches = []
-            for nuc in nuc_labels:
-                if nuc != nuc_region.label:
-                    cn = nuc_region_dict[nuc]
-                    # Get nucleus region and crop
-                    cncol1,cnrow1,cncol2,cnrow2 = cn.bbox
-                    nuc_subsection_cn = nucleus_array[cncol1:cncol2,cnrow1:cnrow2]
-                    mem_subsection_cn = membrane_array[cncol1:cncol2,cnrow1:cnrow2] 
-                    
-                    cn_labels, cn_counts = np.unique(mem_subsection_cn * (nuc_subsection_cn == nuc),return_counts=True)
-                    zeros = np.where(cn_labels==0)[0]
-                    cn_labels, cn_counts = np.delete(cn_labels,zeros), np.delete(cn_counts, zeros)
-                    
-                    cn_id = cn_labels[np.argmax(cn_counts)]
-                    
-                    nuclei_matches.append(cm_id == cn_id)
-            
-            # print(np.sum(nuclei_matches) > 0)
-            
-            cn_id = nuc_labels[np.argmax(nuc_counts)]
-            
-            # There is more than 1 nucleus, whos maximum overlap is with this membrane 
-            if np.sum(nuclei_matches) > 0:
-                # If the membrane doesn't have a clear nucleas counterpart, copy nucleus into mebrane mask for growth 
-                # Gate the nucleus region so that it doesn't copy in irrelevant nuclei
-                # += so that overlapping nucleus regions don't overwrite eachother
-                blank_membrane_for_growth[col1:col2,row1:row2] += (nuc_subsection_nuc * (nuc_subsection_nuc == nuc_region.label)).astype(np.uint32)
-            # Mask is valid
-            else:
-                blank_membrane[mcol1:mcol2,mrow1:mrow2] += (nuc_region.label * (mem_subsection_mem == cm_id)).astype(np.uint32)
-
-        except Exception:
-            # Where no mebrane mask is found - copy nucleus directly in to membrane mask for growth
-            # print(e.with_traceback())
-            col1, row1, col2, row2 = nuc_region.bbox
-            nuc_subsection_nuc = nucleus_array[col1:col2,row1:row2]
-            blank_membrane_for_growth[col1:col2,row1:row2] += (nuc_subsection_nuc * (nuc_subsection_nuc == nuc_region.label)).astype(np.uint32)
+    n_nuc, n_mem = int(nucleus_array.max()) + 1, int(membrane_array.max()) + 1
+    overlap = (nucleus_array > 0) & (membrane_array > 0)
+    # Number of pixels each nucleus shares with each membrane (background excluded)
+    contingency = coo_matrix(
+        (np.ones(np.count_nonzero(overlap), dtype=np.int64), (nucleus_array[overlap], membrane_array[overlap])),
+        shape=(n_nuc, n_mem)).tocsr()
+    contingency.sum_duplicates()
+    del overlap
+
+    # The membrane each nucleus overlaps with the most (the lowest membrane label on ties)
+    has_membrane = np.diff(contingency.indptr) > 0
+    best_membrane = np.asarray(contingency.argmax(axis=1)).ravel()
+    # Number of nuclei whose maximum overlap is with each membrane
+    nuclei_per_membrane = np.bincount(best_membrane[has_membrane], minlength=n_mem)
+
+    nuclei_present = np.zeros(n_nuc, dtype=bool)
+    nuclei_present[np.unique(nucleus_array)] = True
+    nuclei_present[0] = False
+    # There is more than 1 nucleus, whos maximum overlap is with this membrane
+    conflicted = has_membrane & (nuclei_per_membrane[best_membrane] > 1)
+    # Mask is valid, the membrane is labelled with its nucleus
+    valid = nuclei_present & has_membrane & ~conflicted
+    # Where no mebrane mask is found, or it doesn't have a clear nucleas counterpart, copy nucleus into membrane mask for growth
+    for_growth = nuclei_present & ~valid
+
+    membrane_lut = np.zeros(n_mem, dtype=np.uint32)
+    membrane_lut[best_membrane[valid]] = np.nonzero(valid)[0]
+    blank_membrane = membrane_lut[membrane_array]
+
+    growth_lut = np.where(for_growth, np.arange(n_nuc), 0).astype(np.uint32)
+    blank_membrane_for_growth = growth_lut[nucleus_array]
     
     # Taking the nuclei that have been correctly matches, find the mean growth between the nucleus and the membrane along the major and minor axis
     nucleus_with_membrane_df = pd.DataFrame(regionprops_table(nucleus_array * (blank_membrane_for_growth ==0),properties=['label','axis_major_length','axis_minor_length']))
@@ -1,16 +1,28 @@
 from dataclasses import dataclass
 from enum import Enum
+import logging
+import os
 
 from cdb_cellmaps.data import DearrayedTissueMicroArray, DearrayedTissueMicroArrayCellSegmentationMask, MembraneMarkers, NuclearStain, TissueCore, TissueCoreCellSegmentationMask, TissueCoreMembraneSegmentationMask, TissueCoreNucleusSegmentationMask
 from cdb_cellmaps import data_utils
 from cdb_cellmaps.process import Automated, CellSegmentation
 
+import checkpoint #type: ignore
 import hippo_deepcell #type: ignore
+import mask_io #type: ignore
+import membrane_merge #type: ignore
+from pipeline import Stage, run_pipeline #type: ignore
 
 import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
+# Worker threads of the pipeline stages around inference (inference itself runs on a single worker)
+READ_WORKERS = int(os.getenv('DEEPCELL_READ_WORKERS', 2))
+TILE_WORKERS = int(os.getenv('DEEPCELL_TILE_WORKERS', 1))
+POSTPROCESS_WORKERS = int(os.getenv('DEEPCELL_POSTPROCESS_WORKERS', 2))
+WRITE_WORKERS = int(os.getenv('DEEPCELL_WRITE_WORKERS', 2))
+
 # dearrayed_tissue_micro_array,nuclear_stain,membrane_markers,
 
 @dataclass
@@ -61,67 +73,75 @@ class DeepcellDTMA(CellSegmentation,Automated):
     def process(self, prefix, input: DeepcellDTMAProcessInput) -> DeepcellDTMAProcessOutput:
         # helper function
         def merge_membrane_channels(all_channels: TissueCore,markers: MembraneMarkers) -> Image.Image:
-            # retrieve all the membrane marker images
-            imgs =  [np.array(all_channels[mm].read()) for mm in markers]
-            # Some method for merging these images
-            img = Image.fromarray(np.mean(np.stack(imgs),axis=0).astype(np.uint8))
-            return img
-
-        temp = DearrayedTissueMicroArrayCellSegmentationMask()
+            # The membrane marker images are read and merged one at a time (DEEPCELL_MEMBRANE_MERGE sets how)
+            imgs = (np.array(all_channels[mm].read()) for mm in markers)
+            return Image.fromarray(membrane_merge.merge_channels(imgs, len(markers)))
 
-        if len(input.workflow_parameters.membrane_markers) > 1:
-            for core_name, core in input.data.dearrayed_tissue_micro_array.items():
-                # try: 
+        def read(item):
+            core_name, core = item
+            if len(input.workflow_parameters.membrane_markers) > 1:
                 # Create Pseudo Membrane Marker
-                membrane_stain = merge_membrane_channels(core,input.workflow_parameters.membrane_markers) 
-                
-                # Deepcell Segment
-                nucleus_mask, membrane_mask = hippo_deepcell.segment_core(
-                        core[input.workflow_parameters.nuclear_stain].read(),
-                        membrane_stain
-                    )
-                
-                
-                temp[core_name] = TissueCoreCellSegmentationMask(
-                    nucleus_mask=TissueCoreNucleusSegmentationMask.write(
-                        data=nucleus_mask,
-                        prefix=prefix.add_level(core_name),
-                        file_name='nucleus_mask'),
-                    membrane_mask=TissueCoreMembraneSegmentationMask.write(
-                        data=membrane_mask,
-                        prefix=prefix.add_level(core_name),
-                        file_name='membrane_mask'),
-                        )
-                    
-                # except Exception as e:
-                #     logging.warning(f'{core_name} failed, because of: {e.with_traceback}')
-
-        # Case when you don't have to create a pseudo-membrane-mask
-        else:
-            for core_name, core in input.data.dearrayed_tissue_micro_array.items():
-                # try: 
+                membrane_stain = merge_membrane_channels(core,input.workflow_parameters.membrane_markers)
+            # Case when you don't have to create a pseudo-membrane-mask
+            else:
                 # Select First entry from len 1 list
-                membrane_marker = input.workflow_parameters.membrane_markers[0]
-                
-                nucleus_mask, membrane_mask = hippo_deepcell.segment_core(
-                        core[input.workflow_parameters.nuclear_stain].read(),
-                        core[membrane_marker].read(),
+                membrane_stain = core[input.workflow_parameters.membrane_markers[0]].read()
+            nuclear_stain = core[input.workflow_parameters.nuclear_stain].read()
+            # PIL reads lazily, decode here rather than in the next stage
+            membrane_stain.load()
+            nuclear_stain.load()
+            yield core_name, nuclear_stain, membrane_stain
+
+        def tile(item):
+            core_name, nuclear_stain, membrane_stain = item
+            yield (core_name, *hippo_deepcell.prepare_core(nuclear_stain, membrane_stain))
+
+        def postprocess(item):
+            core_name, predictions, tile_info = item
+            yield (core_name, *hippo_deepcell.postprocess_core(predictions, tile_info))
+
+        # Cores finished by an earlier attempt at this job are skipped
+        manifest = checkpoint.Manifest(prefix, self._ROUTING_KEY)
+
+        def write(item):
+            core_name, nucleus_mask, membrane_mask = item
+            # Compact masks (uint16 where the labels fit, tiled, with a label index), see mask_io
+            masks = TissueCoreCellSegmentationMask(
+                nucleus_mask=mask_io.write_mask(
+                    TissueCoreNucleusSegmentationMask,
+                    data=nucleus_mask,
+                    prefix=prefix.add_level(core_name),
+                    file_name='nucleus_mask'),
+                membrane_mask=mask_io.write_mask(
+                    TissueCoreMembraneSegmentationMask,
+                    data=membrane_mask,
+                    prefix=prefix.add_level(core_name),
+                    file_name='membrane_mask'),
                     )
-                
-                temp[core_name] = TissueCoreCellSegmentationMask(
-                    nucleus_mask=TissueCoreNucleusSegmentationMask.write(
-                        data=nucleus_mask,
-                        prefix=prefix.add_level(core_name),
-                        file_name='nucleus_mask'),
-                    membrane_mask=TissueCoreMembraneSegmentationMask.write(
-                        data=membrane_mask,
-                        prefix=prefix.add_level(core_name),
-                        file_name='membrane_mask'),
-                        )
-                    
-                # except Exception as e:
-                #     logging.warning(f'{core_name} failed, because of: {e.with_traceback}')
-        
+            manifest.record(core_name, masks.encode())
+            yield core_name, masks
+
+        # Deepcell Segment, reading / tiling of the next cores and post-processing / writing of the previous ones
+        # overlap with inference, which packs the tiles of all the cores into shared prediction batches
+        batcher = hippo_deepcell.TileBatcher()
+        cores = list(input.data.dearrayed_tissue_micro_array.items())
+        stages = [
+            Stage('read', read, workers=READ_WORKERS),
+            Stage('tile', tile, workers=TILE_WORKERS),
+            Stage('infer', lambda item: batcher.add(*item), flush=batcher.flush),
+            Stage('postprocess', postprocess, workers=POSTPROCESS_WORKERS),
+            Stage('write', write, workers=WRITE_WORKERS),
+        ]
+        written = {core_name: TissueCoreCellSegmentationMask.decode(manifest[core_name]) for core_name, _ in cores if core_name in manifest}
+        for core_name, masks in run_pipeline([(core_name, core) for core_name, core in cores if core_name not in written], stages):
+            written[core_name] = masks
+            logging.warning(f'{core_name} segmented ({len(written)}/{len(cores)})')
+
+        # Assemble the output in input order, so it doesn't depend on the order the workers finished in
+        temp = DearrayedTissueMicroArrayCellSegmentationMask()
+        for core_name, _ in cores:
+            temp[core_name] = written[core_name]
+
         return DeepcellDTMAProcessOutput(
             data=DeepcellDTMAProcessOutput.Data(
                 dearrayed_tissue_micro_array_cell_segmentation_masks=temp
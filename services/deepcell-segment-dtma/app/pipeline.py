@@ -0,0 +1,169 @@
+# Staged pipeline over bounded queues
+# Each stage has its own pool of worker threads and reads from the queue its predecessor writes to, so the stages
+# of different items overlap (e.g. reading core N+1 and post-processing core N-1 while core N is being predicted).
+# Queues are bounded, so a slow stage holds back the ones before it rather than letting items pile up in memory.
+# Threads rather than processes: the heavy lifting (decoding, TensorFlow, scipy / skimage) releases the GIL and
+# the model can't be shared safely with forked workers
+import logging
+import os
+import queue
+import threading
+import time
+
+# Maximum number of items waiting between two stages
+QUEUE_SIZE = int(os.getenv('DEEPCELL_PIPELINE_QUEUE_SIZE', 2))
+
+_DONE = object()
+
+
+class Stage():
+    """
+    One step of a pipeline. fn is called with each input item and returns an iterable of output items (a stage may
+    hold items back, e.g. to batch them, and emit several at once). flush, if given, is called once after the last
+    input item and returns the output items still held back. Stages with state (flush) should have a single worker.
+    """
+    def __init__(self, name, fn, workers=1, flush=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.flush = flush
+        # Metrics
+        self.items = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.depth_samples = 0
+        self.depth_total = 0
+        self.depth_max = 0
+        self._lock = threading.Lock()
+
+    def record(self, busy, blocked, depth):
+        with self._lock:
+            self.items += 1
+            self.busy += busy
+            self.blocked += blocked
+            self.depth_samples += 1
+            self.depth_total += depth
+            self.depth_max = max(self.depth_max, depth)
+
+    def report(self, elapsed):
+        mean_depth = self.depth_total / self.depth_samples if self.depth_samples else 0
+        return (f'{self.name}: {self.items} item(s), {self.workers} worker(s), busy {self.busy:.2f}s '
+                f'({100 * self.busy / max(elapsed * self.workers, 1e-9):.0f}% of worker time), '
+                f'blocked on output {self.blocked:.2f}s, input queue depth mean {mean_depth:.1f} max {self.depth_max}')
+
+
+def run_pipeline(items, stages, queue_size=QUEUE_SIZE):
+    # Feeds items through the stages, yields the outputs of the last stage (in the order they're finished)
+    # After an exception in any stage no more items are fed in, the items already in the pipeline are finished
+    # (e.g. so cores which were only waiting to be written are still written), then the exception is raised here
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    errors = []
+    failed = threading.Event()
+    # Set when the consumer stops early, everything is then abandoned
+    stop = threading.Event()
+    start = time.perf_counter()
+
+    def put(q, item):
+        # Gives up if the pipeline has been stopped, so no worker is left blocked on a full queue
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                if failed.is_set() or not put(queues[0], item):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            failed.set()
+        finally:
+            for _ in range(stages[0].workers):
+                put(queues[0], _DONE)
+
+    def work(stage, inbox, outbox, remaining):
+        try:
+            while not stop.is_set():
+                depth = inbox.qsize()
+                item = inbox.get()
+                if item is _DONE:
+                    break
+                started = time.perf_counter()
+                try:
+                    outputs = list(stage.fn(item))
+                except Exception as e:
+                    # The item is dropped, the rest carry on through the pipeline
+                    errors.append(e)
+                    failed.set()
+                    continue
+                busy = time.perf_counter() - started
+                for output in outputs:
+                    if not put(outbox, output):
+                        return
+                stage.record(busy, time.perf_counter() - started - busy, depth)
+            else:
+                return
+            with remaining['lock']:
+                remaining['workers'] -= 1
+                last = remaining['workers'] == 0
+            if last:
+                # The last worker of the stage to finish flushes it and passes the end on
+                if stage.flush is not None:
+                    try:
+                        outputs = list(stage.flush())
+                    except Exception as e:
+                        errors.append(e)
+                        outputs = []
+                    for output in outputs:
+                        if not put(outbox, output):
+                            return
+                for _ in range(remaining['next_workers']):
+                    put(outbox, _DONE)
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for i, stage in enumerate(stages):
+        remaining = {
+            'lock': threading.Lock(),
+            'workers': stage.workers,
+            'next_workers': stages[i + 1].workers if i + 1 < len(stages) else 1,
+        }
+        threads += [
+            threading.Thread(target=work, args=(stage, queues[i], queues[i + 1], remaining), daemon=True, name=f'{stage.name}-{w}')
+            for w in range(stage.workers)
+        ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        while True:
+            try:
+                item = queues[-1].get(timeout=0.1)
+            except queue.Empty:
+                if stop.is_set():
+                    break
+                continue
+            if item is _DONE:
+                break
+            yield item
+    finally:
+        stop.set()
+        # Unblock any worker still waiting on an input queue
+        for q, stage in zip(queues, stages):
+            for _ in range(stage.workers):
+                try:
+                    q.put_nowait(_DONE)
+                except queue.Full:
+                    break
+        elapsed = time.perf_counter() - start
+        for stage in stages:
+            logging.warning(stage.report(elapsed))
+
+    if errors:
+        raise errors[0]
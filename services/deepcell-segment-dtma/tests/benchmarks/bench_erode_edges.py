@@ -0,0 +1,60 @@
+# Benchmark for the edge erosion of hippo_deepcell's post-processing
+# Times erode_edges_batch over a stack of tiles against the per tile, per compartment loop of deepcell_toolbox's
+# erode_edges it replaced, and checks the two give the same masks
+#
+# Run from the service root: python tests/benchmarks/bench_erode_edges.py [n_tiles] [erosion_width]
+# The tiles are synthetic label images of random blobs, as Mesmer's predictions look before erosion
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from deepcell_toolbox.utils import erode_edges
+from scipy.ndimage import distance_transform_edt
+from skimage.measure import label
+
+APP_DIR = Path(__file__).resolve().parents[2] / 'app'
+sys.path.insert(0, str(APP_DIR))
+import hippo_deepcell #type: ignore
+
+
+def synthetic_predictions(n, rng, size=hippo_deepcell.TILE_SIZE):
+    predictions = np.zeros((n, size, size, 2), dtype=np.int32)
+    for tile in predictions:
+        for compartment in range(2):
+            centres = np.zeros((size, size), dtype=bool)
+            centres[rng.integers(0, size, 60), rng.integers(0, size, 60)] = True
+            # Blobs of a few pixels radius around each centre, touching blobs are split by their nearest centre
+            distance, (rows, cols) = distance_transform_edt(~centres, return_indices=True)
+            tile[..., compartment] = np.where(distance < 6, label(centres)[rows, cols], 0)
+    return predictions
+
+
+def per_tile(predictions, width):
+    for i in range(predictions.shape[0]):
+        predictions[i, ..., 0] = erode_edges(predictions[i, ..., 0], width)
+        predictions[i, ..., 1] = erode_edges(predictions[i, ..., 1], width)
+    return predictions
+
+
+if __name__ == '__main__':
+    n_tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else hippo_deepcell.ERODE_WIDTH
+    predictions = synthetic_predictions(n_tiles, np.random.default_rng(0))
+    print(f'{n_tiles} tiles of {hippo_deepcell.TILE_SIZE}x{hippo_deepcell.TILE_SIZE}, erosion width {width}')
+
+    reference = predictions.copy()
+    start = time.perf_counter()
+    per_tile(reference, width)
+    loop_time = time.perf_counter() - start
+    print(f'per tile loop: {loop_time:.3f}s ({n_tiles / loop_time:.0f} tiles/s)')
+
+    batched = predictions.copy()
+    start = time.perf_counter()
+    hippo_deepcell.erode_edges_batch(batched, width)
+    batch_time = time.perf_counter() - start
+    print(f'batched:       {batch_time:.3f}s ({n_tiles / batch_time:.0f} tiles/s, {loop_time / batch_time:.2f}x)')
+
+    identical = np.array_equal(reference, batched)
+    print('masks identical' if identical else 'MASKS DIFFER')
+    sys.exit(0 if identical else 1)
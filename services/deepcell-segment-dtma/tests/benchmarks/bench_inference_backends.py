@@ -0,0 +1,75 @@
+# Benchmark for the Mesmer inference backends of hippo_deepcell
+# Times each backend's predictions in tiles per second (after a warm up batch) and checks its model outputs and
+# masks against the keras backend's, the reference
+#
+# Run from the service root: python tests/benchmarks/bench_inference_backends.py [n_tiles] [backend ...]
+# e.g. DEEPCELL_INTRA_OP_THREADS=8 DEEPCELL_INTER_OP_THREADS=2 python tests/benchmarks/bench_inference_backends.py 256 keras xla frozen
+# The tiles are synthetic: blobs of nuclear stain, each surrounded by a ring of membrane stain
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+APP_DIR = Path(__file__).resolve().parents[2] / 'app'
+sys.path.insert(0, str(APP_DIR))
+import hippo_deepcell #type: ignore
+
+# Largest absolute difference allowed between a backend's model outputs and the reference's
+OUTPUT_TOLERANCE = 1e-3
+# Smallest share of pixels on which a backend's masks must agree with the reference's (cell or background)
+MASK_AGREEMENT = 0.999
+
+
+def synthetic_tiles(n, rng, size=hippo_deepcell.TILE_SIZE):
+    tiles = np.zeros((n, size, size, 2), dtype=np.float32)
+    for tile in tiles:
+        centres = np.zeros((size, size))
+        centres[rng.integers(0, size, 40), rng.integers(0, size, 40)] = 1
+        nucleus = gaussian_filter(centres, 3)
+        membrane = gaussian_filter(centres, 7) - gaussian_filter(centres, 5)
+        tile[..., 0] = 255 * nucleus / max(nucleus.max(), 1e-9)
+        tile[..., 1] = 255 * np.clip(membrane, 0, None) / max(membrane.max(), 1e-9)
+    return tiles
+
+
+def run_backend(backend, tiles):
+    app = hippo_deepcell.load_mesmer_app(backend)
+    batch_size = hippo_deepcell.BATCH_SIZE
+
+    def predict(x):
+        return app.predict(x, image_mpp=hippo_deepcell.MICRONS_PER_PIX, compartment='both', batch_size=batch_size)
+
+    # Warm up (tracing / compilation) isn't part of the throughput
+    predict(tiles[:batch_size])
+    start = time.perf_counter()
+    masks = predict(tiles)
+    elapsed = time.perf_counter() - start
+    outputs = app.model.predict(tiles, batch_size=batch_size)
+    return masks, outputs if isinstance(outputs, list) else [outputs], len(tiles) / elapsed
+
+
+if __name__ == '__main__':
+    n_tiles = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    backends = sys.argv[2:] or ['keras', 'xla', 'frozen']
+    tiles = synthetic_tiles(n_tiles, np.random.default_rng(0))
+
+    print(f'{n_tiles} tiles of {hippo_deepcell.TILE_SIZE}x{hippo_deepcell.TILE_SIZE}, batch size {hippo_deepcell.BATCH_SIZE}, '
+          f'intra op threads {hippo_deepcell.INTRA_OP_THREADS or "default"}, inter op threads {hippo_deepcell.INTER_OP_THREADS or "default"}')
+    reference_masks, reference_outputs, reference_rate = run_backend('keras', tiles)
+    print(f'keras:  {reference_rate:.1f} tiles/s (reference)')
+
+    failed = False
+    for backend in backends:
+        if backend == 'keras':
+            continue
+        masks, outputs, rate = run_backend(backend, tiles)
+        difference = max(float(np.abs(o - r).max()) for o, r in zip(outputs, reference_outputs))
+        agreement = float(np.mean((masks > 0) == (reference_masks > 0)))
+        ok = difference <= OUTPUT_TOLERANCE and agreement >= MASK_AGREEMENT
+        failed |= not ok
+        print(f'{backend + ":":7} {rate:.1f} tiles/s ({rate / reference_rate:.2f}x), largest output difference {difference:.2e}, '
+              f'mask agreement {100 * agreement:.3f}% {"ok" if ok else "OUTSIDE TOLERANCE"}')
+
+    sys.exit(1 if failed else 0)
@@ -1,16 +1,25 @@
+from contextlib import ExitStack
 from dataclasses import dataclass
 from enum import Enum
+import os
 
 from cdb_cellmaps.data import  MembraneMarkers, NuclearStain, WholeSlideImage, WholeSlideImageCellSegmentationMask, WholeSlideImageMembraneSegmentationMask, WholeSlideImageNucleusSegmentationMask
 from cdb_cellmaps import data_utils
 from cdb_cellmaps.process import Automated, CellSegmentation
 
 import hippo_deepcell #type: ignore
+import mask_io #type: ignore
+import membrane_merge #type: ignore
+import pyramid #type: ignore
+import wsi_segmentation #type: ignore
 
 import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
+# 'windowed' segments the slide in overlapping windows (bounded memory), 'whole' segments it in one piece
+WSI_MODE = os.getenv('DEEPCELL_WSI_MODE', 'windowed')
+
 @dataclass
 class DeepcellWSIProcessInput:
     @dataclass
@@ -62,18 +71,17 @@ class DeepcellWSI(CellSegmentation,Automated):
         # helper function
         def merge_membrane_channels(all_channels: WholeSlideImage, markers: MembraneMarkers) -> Image.Image:
             
-            # retrieve all the membrane marker images
-            imgs =  [np.array(all_channels[mm].read()) for mm in markers]
-            
-            # Some method for merging these images
-            img = Image.fromarray(np.mean(np.stack(imgs),axis=0).astype(np.uint8))
-            
-            return img
+            # The membrane marker images are read and merged one at a time (DEEPCELL_MEMBRANE_MERGE sets how)
+            imgs = (np.array(all_channels[mm].read()) for mm in markers)
+            return Image.fromarray(membrane_merge.merge_channels(imgs, len(markers)))
 
 
         
 
-        if len(input.workflow_parameters.membrane_markers) > 1:
+        if WSI_MODE == 'windowed':
+            temp = self.segment_windowed(prefix, input)
+
+        elif len(input.workflow_parameters.membrane_markers) > 1:
             membrane_stain = merge_membrane_channels(
                 input.data.whole_slide_image,
                 input.workflow_parameters.membrane_markers) 
@@ -86,11 +94,11 @@ class DeepcellWSI(CellSegmentation,Automated):
             
             # Write masks to disk
             temp = WholeSlideImageCellSegmentationMask(
-                nucleus_mask= WholeSlideImageNucleusSegmentationMask.write(data=nucleus_mask,
+                nucleus_mask= mask_io.write_mask(WholeSlideImageNucleusSegmentationMask, data=nucleus_mask,
                                                                             prefix=prefix,
                                                                             file_name='nucleus_mask'),
 
-                membrane_mask=WholeSlideImageMembraneSegmentationMask.write(data=membrane_mask,
+                membrane_mask=mask_io.write_mask(WholeSlideImageMembraneSegmentationMask, data=membrane_mask,
                                                                             prefix=prefix,
                                                                             file_name='membrane_mask')
             )
@@ -109,11 +117,11 @@ class DeepcellWSI(CellSegmentation,Automated):
 
             # Write masks to disk
             temp = WholeSlideImageCellSegmentationMask(
-                nucleus_mask= WholeSlideImageNucleusSegmentationMask.write(data=nucleus_mask,
+                nucleus_mask= mask_io.write_mask(WholeSlideImageNucleusSegmentationMask, data=nucleus_mask,
                                                                             prefix=prefix,
                                                                             file_name='nucleus_mask'),
 
-                membrane_mask=WholeSlideImageMembraneSegmentationMask.write(data=membrane_mask,
+                membrane_mask=mask_io.write_mask(WholeSlideImageMembraneSegmentationMask, data=membrane_mask,
                                                                             prefix=prefix,
                                                                             file_name='membrane_mask')
             )
@@ -125,6 +133,41 @@ class DeepcellWSI(CellSegmentation,Automated):
                 whole_slide_image_cell_segmentation_masks=temp
             )
         )
+
+    def segment_windowed(self, prefix, input: DeepcellWSIProcessInput) -> WholeSlideImageCellSegmentationMask:
+        nuclear_stain = input.workflow_parameters.nuclear_stain
+        markers = input.workflow_parameters.membrane_markers
+
+        with ExitStack() as stack:
+            # Full resolution page of each channel, windows are read from them tile by tile
+            pages = {
+                channel: pyramid.levels(stack.enter_context(pyramid.open_channel(input.data.whole_slide_image[channel])))[0]
+                for channel in dict.fromkeys([nuclear_stain, *markers])
+            }
+
+            def read_window(top, left, height, width):
+                nucleus = pyramid.read_region(pages[nuclear_stain], top, left, height, width)
+                if len(markers) > 1:
+                    # Create Pseudo Membrane Marker, merging the window of each marker in turn
+                    membrane = membrane_merge.merge_channels(
+                        (pyramid.read_region(pages[mm], top, left, height, width) for mm in markers), len(markers))
+                else:
+                    membrane = pyramid.read_region(pages[markers[0]], top, left, height, width)
+                return Image.fromarray(nucleus), Image.fromarray(membrane)
+
+            shape = pages[nuclear_stain].shape
+            nucleus_mask, membrane_mask = wsi_segmentation.publish_masks(
+                [WholeSlideImageNucleusSegmentationMask, WholeSlideImageMembraneSegmentationMask],
+                wsi_segmentation.segment_slide(read_window, shape),
+                shape,
+                prefix,
+                ['nucleus_mask', 'membrane_mask'])
+
+        return WholeSlideImageCellSegmentationMask(
+            nucleus_mask=nucleus_mask,
+            membrane_mask=membrane_mask
+        )
+
     
 if __name__ == '__main__':
     DeepcellWSI().run()
\ No newline at end of file
@@ -0,0 +1,207 @@
+# Storage of label masks (nucleus / membrane segmentation masks)
+# Masks are written as tiled, zlib compressed (OME-)TIFFs, as uint16 when every label fits (uint32 otherwise).
+# Optionally a label index is written into the same file as two further series: the bounding box of each label and
+# the horizontal runs of pixels it covers, so the pixels of a cell can be read without scanning the whole mask.
+# The mask itself is still the first image of the file, so readers which don't know about the index are unaffected
+from contextlib import contextmanager
+import io
+import os
+import tempfile
+
+import numpy as np
+import requests
+import tifffile #type: ignore
+
+from cdb_cellmaps._config import Config as _Config
+
+# Tile size of the written masks
+MASK_TILE_SIZE = 512
+# 'True' to write the label index with each mask (it's about as large again as the compressed mask)
+MASK_INDEX = os.getenv('MASK_LABEL_INDEX', 'False') == 'True'
+
+
+class LabelIndex():
+    """
+    Where each label of a mask is. For label labels[i], bbox[i] is (min_row, min_col, max_row, max_col) (max
+    exclusive, as skimage's bbox) and its pixels are the runs runs[run_start[i]:run_start[i] + run_count[i]], each
+    (row, col, length), in row major order.
+    """
+    def __init__(self, labels, bbox, run_start, run_count, runs):
+        self.labels = labels
+        self.bbox = bbox
+        self.run_start = run_start
+        self.run_count = run_count
+        self.runs = runs
+        self._positions = {int(label): i for i, label in enumerate(labels)}
+
+    @classmethod
+    def from_mask(cls, mask):
+        mask = np.asarray(mask)
+        # A run starts where the label changes along the row and ends before the next change
+        starts = mask > 0
+        starts[:, 1:] &= mask[:, 1:] != mask[:, :-1]
+        ends = mask > 0
+        ends[:, :-1] &= mask[:, :-1] != mask[:, 1:]
+        rows, cols = np.nonzero(starts)
+        _, end_cols = np.nonzero(ends)
+        labels = mask[rows, cols]
+
+        # Group the runs by label, keeping them in row major order within each label
+        order = np.argsort(labels, kind='stable')
+        rows, cols, end_cols, labels = rows[order], cols[order], end_cols[order], labels[order]
+        unique, run_start, run_count = np.unique(labels, return_index=True, return_counts=True)
+        bbox = np.stack([
+            rows[run_start],
+            np.minimum.reduceat(cols, run_start) if len(run_start) else cols[:0],
+            rows[run_start + run_count - 1] + 1,
+            np.maximum.reduceat(end_cols, run_start) + 1 if len(run_start) else cols[:0],
+        ], axis=1)
+        # Runs are within the image, so fit in 16 bits unless it's more than 65535 pixels across
+        runs = np.stack([rows, cols, end_cols - cols + 1], axis=1).astype(mask_dtype(max(mask.shape)))
+        return cls(unique.astype(np.uint32), bbox.astype(np.uint32), run_start.astype(np.uint32), run_count.astype(np.uint32), runs)
+
+    @classmethod
+    def from_arrays(cls, table, runs):
+        # The two series stored in the mask file, a row per field (see to_arrays)
+        table, runs = table.T, runs.T
+        return cls(table[:, 0], table[:, 1:5], table[:, 5], table[:, 6], runs[:int(table[:, 6].sum())])
+
+    def to_arrays(self):
+        # Stored a row per field, so neighbouring values (e.g. the rows of consecutive runs) are next to each other,
+        # which the horizontal predictor turns into small differences which compress well
+        table = np.column_stack([self.labels, self.bbox, self.run_start, self.run_count]).astype(np.uint32)
+        # A TIFF image can't be empty
+        runs = self.runs if len(self.runs) else np.zeros((1, 3), dtype=self.runs.dtype)
+        return np.ascontiguousarray(table.T), np.ascontiguousarray(runs.T)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __contains__(self, label):
+        return int(label) in self._positions
+
+    def label_bbox(self, label):
+        return tuple(int(v) for v in self.bbox[self._positions[int(label)]])
+
+    def label_runs(self, label):
+        i = self._positions[int(label)]
+        return self.runs[self.run_start[i]:self.run_start[i] + self.run_count[i]]
+
+    def pixels(self, label):
+        # (rows, cols) of every pixel of the label, as np.nonzero(mask == label) would give them
+        runs = self.label_runs(label).astype(np.int64)
+        lengths = runs[:, 2]
+        rows = np.repeat(runs[:, 0], lengths)
+        # Column of each pixel: the start of its run plus its position within the run
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        return rows, np.repeat(runs[:, 1], lengths) + within
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object over a url which supports range requests (such as a presigned minio url),
+    each read is a ranged GET, so only the bytes which are actually needed are transferred.
+    """
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session or requests.Session()
+        self.position = 0
+        # The size of the object, from the Content-Range of a one byte request (a HEAD isn't valid for a presigned GET)
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            r.raise_for_status()
+            self.size = int(r.headers['Content-Range'].split('/')[-1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.position)
+        if n <= 0:
+            return 0
+        r = self.session.get(self.url, headers={'Range': f'bytes={self.position}-{self.position + n - 1}'})
+        r.raise_for_status()
+        data = r.content
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+def mask_dtype(max_label):
+    return np.uint16 if max_label <= np.iinfo(np.uint16).max else np.uint32
+
+
+def write_mask_file(mask, path, index=None):
+    mask = np.asarray(mask)
+    index = MASK_INDEX if index is None else index
+    with tifffile.TiffWriter(path, ome=True, bigtiff=mask.size * 4 > 2 ** 32 - 2 ** 25) as tif:
+        tif.write(mask.astype(mask_dtype(int(mask.max(initial=0))), copy=False), tile=(MASK_TILE_SIZE, MASK_TILE_SIZE),
+                  compression='zlib', metadata={'Name': 'mask'})
+        label_index = LabelIndex.from_mask(mask) if index else None
+        if label_index is not None and len(label_index):
+            table, runs = label_index.to_arrays()
+            tif.write(table, compression='zlib', predictor=True, metadata={'Name': 'label_index'})
+            tif.write(runs, compression='zlib', predictor=True, metadata={'Name': 'label_runs'})
+
+
+def write_mask(cls, data, prefix, file_name, index=None):
+    # Writes the mask (a PIL image or an array) and stores it the same way cls.write would (locally in debug, in the
+    # workflow bucket otherwise), returns an instance of cls pointing at it
+    if _Config.DEBUG():
+        os.makedirs(prefix[1:], exist_ok=True)
+        path = os.path.join(prefix[1:], file_name + cls.FILE_EXTENSION)
+        write_mask_file(data, path, index)
+        return cls(url=os.path.abspath(path))
+
+    from cdb_cellmaps._utils import get_minio_client
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, file_name + cls.FILE_EXTENSION)
+        write_mask_file(data, path, index)
+        client = get_minio_client()
+        object_name = f"{prefix}{file_name}{cls.FILE_EXTENSION}"
+        client.fput_object(
+            bucket_name=_Config._MINIO_WORKFLOW_BUCKET,
+            object_name=object_name,
+            file_path=path,
+            num_parallel_uploads=_Config._MINIO_NUM_PARALLEL_UPLOADS)
+        return cls(url=client.get_presigned_url('GET', _Config._MINIO_WORKFLOW_BUCKET, object_name))
+
+
+@contextmanager
+def open_mask(file):
+    # In debug mode the url is a local path, otherwise the object is read with ranged requests rather than downloaded
+    if _Config.DEBUG() or os.path.exists(file.url):
+        with tifffile.TiffFile(file.url) as tf:
+            yield tf
+    else:
+        with io.BufferedReader(HTTPRangeFile(file.url), buffer_size=1 << 20) as fh, tifffile.TiffFile(fh) as tf:
+            yield tf
+
+
+def read_mask(file):
+    # The mask as an array (of the dtype it was stored with)
+    with open_mask(file) as tf:
+        return tf.series[0].asarray()
+
+
+def read_label_index(file):
+    # The LabelIndex stored with the mask, None if it was written without one (or has no labels)
+    with open_mask(file) as tf:
+        series = {s.name: s for s in tf.series}
+        if 'label_index' not in series:
+            return None
+        return LabelIndex.from_arrays(series['label_index'].asarray(), series['label_runs'].asarray())
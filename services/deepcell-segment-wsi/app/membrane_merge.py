@@ -0,0 +1,94 @@
+# Merging of the membrane marker channels into the pseudo membrane image deepcell segments with
+# Channels are folded into the result one at a time (a whole channel, or the same window of each channel), so the
+# merge holds an accumulator and the channel being added rather than a stack of every channel
+import os
+
+import numpy as np
+
+# 'mean' (the default, as the services have always merged), 'max' or 'weighted'
+MERGE_STRATEGY = os.getenv('DEEPCELL_MEMBRANE_MERGE', 'mean')
+# Weights of the membrane markers for the 'weighted' strategy, comma separated in the order of the markers
+MERGE_WEIGHTS = [float(w) for w in os.getenv('DEEPCELL_MEMBRANE_WEIGHTS', '').split(',') if w.strip()]
+
+
+class MeanMerge():
+    """
+    Mean of the channels, truncated to uint8 (the same as np.mean(np.stack(channels), axis=0).astype(np.uint8)).
+    Integer channels are summed in the smallest unsigned integer type which can't overflow, so the mean is exact.
+    """
+    def __init__(self, n_channels):
+        self.n_channels = n_channels
+        self.total = None
+
+    def add(self, channel):
+        if self.total is None:
+            self.total = np.zeros(channel.shape, dtype=_sum_dtype(channel.dtype, self.n_channels))
+        self.total += channel
+
+    def result(self):
+        if np.issubdtype(self.total.dtype, np.integer):
+            return (self.total // self.n_channels).astype(np.uint8)
+        return (self.total / self.n_channels).astype(np.uint8)
+
+
+class MaxMerge():
+    """
+    Pixelwise maximum of the channels.
+    """
+    def __init__(self, n_channels):
+        self.maximum = None
+
+    def add(self, channel):
+        if self.maximum is None:
+            self.maximum = np.array(channel, copy=True)
+        else:
+            np.maximum(self.maximum, channel, out=self.maximum)
+
+    def result(self):
+        return self.maximum.astype(np.uint8)
+
+
+class WeightedMerge():
+    """
+    Weighted mean of the channels (weights in the order the channels are added), accumulated in float32.
+    """
+    def __init__(self, n_channels, weights=None):
+        weights = MERGE_WEIGHTS if weights is None else weights
+        if len(weights) != n_channels:
+            raise ValueError(f'{n_channels} membrane markers but {len(weights)} weights, set DEEPCELL_MEMBRANE_WEIGHTS with a weight per marker')
+        self.weights = np.asarray(weights, dtype=np.float32) / np.sum(weights, dtype=np.float32)
+        self.total = None
+        self.added = 0
+
+    def add(self, channel):
+        if self.total is None:
+            self.total = np.zeros(channel.shape, dtype=np.float32)
+        self.total += self.weights[self.added] * channel.astype(np.float32)
+        self.added += 1
+
+    def result(self):
+        return np.clip(self.total, 0, 255).astype(np.uint8)
+
+
+STRATEGIES = {
+    'mean': MeanMerge,
+    'max': MaxMerge,
+    'weighted': WeightedMerge,
+}
+
+
+def _sum_dtype(dtype, n_channels):
+    if not np.issubdtype(dtype, np.unsignedinteger):
+        return np.float64
+    for candidate in (np.uint16, np.uint32, np.uint64):
+        if np.iinfo(dtype).max * n_channels <= np.iinfo(candidate).max:
+            return candidate
+    return np.float64
+
+
+def merge_channels(channels, n_channels, strategy=None):
+    # channels is an iterable of 2D arrays (e.g. a generator reading each marker in turn), returns the uint8 merge
+    merger = STRATEGIES[strategy or MERGE_STRATEGY](n_channels)
+    for channel in channels:
+        merger.add(np.asarray(channel))
+    return merger.result()
@@ -0,0 +1,202 @@
+# Whole slide segmentation in overlapping windows
+# The slide is segmented one large window at a time, rows of windows from top to bottom. Each object (a nucleus and
+# the membrane labelled with it) belongs to the window its nucleus' centroid falls in the middle of, objects of a
+# window which overlap an object already stitched from a neighbouring window are merged with it. Rows of the masks
+# are written to tiled TIFFs as soon as no later window can touch them, so only a band of windows' height is held
+# in memory whatever the size of the slide
+import logging
+import os
+import queue
+import tempfile
+import threading
+
+import numpy as np
+import tifffile #type: ignore
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = None
+
+from cdb_cellmaps._config import Config as _Config
+
+import hippo_deepcell #type: ignore
+
+# Size of the windows the slide is segmented in, and how much neighbouring windows overlap
+# The overlap should be at least twice the size of the largest cell, so every cell is whole in the window it belongs to
+WINDOW_SIZE = int(os.getenv('DEEPCELL_WSI_WINDOW_SIZE', 4096))
+WINDOW_OVERLAP = int(os.getenv('DEEPCELL_WSI_WINDOW_OVERLAP', 256))
+# Share of an object's pixels which must overlap a single stitched object for the two to be merged
+MATCH_THRESHOLD = float(os.getenv('DEEPCELL_WSI_MATCH_THRESHOLD', 0.5))
+# Tile size of the written masks
+MASK_TILE_SIZE = 512
+
+
+def window_bounds(length, size=WINDOW_SIZE, overlap=WINDOW_OVERLAP):
+    # (start, stop, owned_start, owned_stop) of the windows along an axis, the last window is aligned to the end
+    # Each window owns the part of the axis up to the middle of its overlaps with its neighbours
+    stride = max(size - overlap, 1)
+    starts = list(range(0, max(length - size, 0), stride)) + [max(length - size, 0)]
+    stops = [min(start + size, length) for start in starts]
+    middles = [(start + stop) // 2 for start, stop in zip(starts[1:], stops[:-1])]
+    return list(zip(starts, stops, [0] + middles, middles + [length]))
+
+
+def centroids(labels):
+    # Centroid (row, column) of every label, NaN for labels which aren't present
+    rows, cols = np.nonzero(labels)
+    values = labels[rows, cols]
+    counts = np.bincount(values, minlength=int(labels.max()) + 1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.bincount(values, weights=rows, minlength=len(counts)) / counts, np.bincount(values, weights=cols, minlength=len(counts)) / counts
+
+
+def stitch_window(nucleus_buffer, membrane_buffer, nucleus, membrane, owned, next_id):
+    # Adds the objects the window owns to the buffers (views of the window's area in global labels), returns the next
+    # free global label. owned is (owned_top, owned_bottom, owned_left, owned_right) in window coordinates
+    cy, cx = centroids(nucleus)
+    owned_top, owned_bottom, owned_left, owned_right = owned
+    keep = (cy >= owned_top) & (cy < owned_bottom) & (cx >= owned_left) & (cx < owned_right)
+    keep[0] = False
+
+    # Pixels each kept object shares with each object already stitched (from the neighbouring windows)
+    pixels = keep[nucleus] & (nucleus_buffer > 0)
+    local_ids, shared = nucleus[pixels], nucleus_buffer[pixels]
+    lut = np.zeros(len(keep), dtype=np.uint32)
+    if len(local_ids):
+        n_shared = int(shared.max()) + 1
+        pairs, overlap = np.unique(local_ids.astype(np.uint64) * n_shared + shared, return_counts=True)
+        local_ids, shared = (pairs // n_shared).astype(np.int64), (pairs % n_shared).astype(np.uint32)
+        # The stitched object each kept object overlaps with the most (the lowest label on ties)
+        order = np.lexsort((-overlap, local_ids))
+        first = order[np.r_[True, local_ids[order][1:] != local_ids[order][:-1]]]
+        area = np.bincount(nucleus.ravel(), minlength=len(keep))
+        matched = first[overlap[first] >= MATCH_THRESHOLD * area[local_ids[first]]]
+        lut[local_ids[matched]] = shared[matched]
+
+    # The other kept objects are new, they're labelled in the order they're found
+    new = keep & (lut == 0)
+    lut[new] = np.arange(next_id, next_id + np.count_nonzero(new), dtype=np.uint32)
+
+    # Pixels already claimed by a stitched object are left as they are, merged objects take the union of both
+    for buffer, labels in ((nucleus_buffer, nucleus), (membrane_buffer, membrane)):
+        relabelled = lut[labels]
+        free = (buffer == 0) & (relabelled > 0)
+        buffer[free] = relabelled[free]
+    return next_id + int(np.count_nonzero(new))
+
+
+def segment_slide(read_window, shape):
+    # Yields (top, nucleus_band, membrane_band), the final labels of consecutive rows of the slide, from the top
+    # read_window(top, left, height, width) returns the (nucleus, membrane) images of a window as PIL images
+    height, width = shape
+    rows, cols = window_bounds(height), window_bounds(width)
+    next_id = 1
+    # Global labels of the rows the current row of windows covers, the rows it shares with the previous row are kept
+    carried_nucleus = carried_membrane = np.zeros((0, width), dtype=np.uint32)
+    for i, (top, bottom, owned_top, owned_bottom) in enumerate(rows):
+        nucleus_band = np.zeros((bottom - top, width), dtype=np.uint32)
+        membrane_band = np.zeros((bottom - top, width), dtype=np.uint32)
+        nucleus_band[:len(carried_nucleus)] = carried_nucleus
+        membrane_band[:len(carried_membrane)] = carried_membrane
+
+        for left, right, owned_left, owned_right in cols:
+            nucleus_img, membrane_img = read_window(top, left, bottom - top, right - left)
+            nucleus_mask, membrane_mask = hippo_deepcell.segment_core(nucleus_img, membrane_img)
+            next_id = stitch_window(
+                nucleus_band[:, left:right], membrane_band[:, left:right],
+                np.array(nucleus_mask, dtype=np.uint32), np.array(membrane_mask, dtype=np.uint32),
+                (owned_top - top, owned_bottom - top, owned_left - left, owned_right - left), next_id)
+            logging.warning(f'Window ({top}, {left}) segmented, {next_id - 1} cells so far')
+
+        # Rows above the next row of windows are final
+        final = rows[i + 1][0] - top if i + 1 < len(rows) else bottom - top
+        yield top, nucleus_band[:final], membrane_band[:final]
+        carried_nucleus, carried_membrane = nucleus_band[final:], membrane_band[final:]
+
+
+def tile_rows(bands, tile_size=MASK_TILE_SIZE):
+    # Regroups bands of any height into bands of whole rows of tiles (the last one may be shorter)
+    pending = []
+    for _, band in bands:
+        pending.append(band)
+        rows = sum(len(b) for b in pending)
+        if rows >= tile_size:
+            joined = np.concatenate(pending)
+            split = rows - rows % tile_size
+            yield joined[:split]
+            pending = [joined[split:]]
+    if sum(len(b) for b in pending):
+        yield np.concatenate(pending)
+
+
+def iter_tiles(bands, width, tile_size=MASK_TILE_SIZE):
+    # Yields the tiles of the bands in the order tifffile writes them
+    for band in tile_rows(bands, tile_size):
+        for top in range(0, band.shape[0], tile_size):
+            for left in range(0, width, tile_size):
+                tile = np.zeros((tile_size, tile_size), dtype=band.dtype)
+                part = band[top:top + tile_size, left:left + tile_size]
+                tile[:part.shape[0], :part.shape[1]] = part
+                yield tile
+
+
+def write_masks(bands, shape, paths):
+    # Writes the nucleus and membrane bands to tiled, zlib compressed TIFFs as they're produced, one writer thread
+    # per mask, each fed through a short queue
+    queues = [queue.Queue(maxsize=2) for _ in paths]
+    errors = []
+
+    def queued_bands(q):
+        while (item := q.get()) is not None:
+            yield item
+
+    def write(path, q):
+        try:
+            bigtiff = shape[0] * shape[1] * 4 > 2 ** 32 - 2 ** 25
+            with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+                tif.write(iter_tiles(queued_bands(q), shape[1]), shape=shape, dtype=np.uint32,
+                          tile=(MASK_TILE_SIZE, MASK_TILE_SIZE), compression='zlib')
+        except BaseException as e:
+            errors.append(e)
+            # Keep taking bands, so the producer isn't blocked
+            for _ in queued_bands(q):
+                pass
+
+    threads = [threading.Thread(target=write, args=(path, q), daemon=True) for path, q in zip(paths, queues)]
+    for thread in threads:
+        thread.start()
+    try:
+        for top, *masks in bands:
+            for q, mask in zip(queues, masks):
+                q.put((top, mask))
+    finally:
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def publish_masks(classes, bands, shape, prefix, file_names):
+    # Writes the masks and stores them the same way cls.write would (locally in debug, in the workflow bucket
+    # otherwise), returns an instance of each class pointing at its mask
+    if _Config.DEBUG():
+        os.makedirs(prefix[1:], exist_ok=True)
+        paths = [os.path.join(prefix[1:], file_name + cls.FILE_EXTENSION) for cls, file_name in zip(classes, file_names)]
+        write_masks(bands, shape, paths)
+        return [cls(url=os.path.abspath(path)) for cls, path in zip(classes, paths)]
+
+    from cdb_cellmaps._utils import get_minio_client
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [os.path.join(tmp, file_name + cls.FILE_EXTENSION) for cls, file_name in zip(classes, file_names)]
+        write_masks(bands, shape, paths)
+        client = get_minio_client()
+        written = []
+        for cls, file_name, path in zip(classes, file_names, paths):
+            object_name = f"{prefix}{file_name}{cls.FILE_EXTENSION}"
+            client.fput_object(
+                bucket_name=_Config._MINIO_WORKFLOW_BUCKET,
+                object_name=object_name,
+                file_path=path,
+                num_parallel_uploads=_Config._MINIO_NUM_PARALLEL_UPLOADS)
+            written.append(cls(url=client.get_presigned_url('GET', _Config._MINIO_WORKFLOW_BUCKET, object_name)))
+        return written
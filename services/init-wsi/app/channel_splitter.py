@@ -0,0 +1,243 @@
+# Splits a stacked (multi page) TIFF into one tiled, compressed TIFF per protein channel
+# Pages are read strip by strip / tile by tile, from a local file or straight from a (presigned) url with ranged
+# requests, and each channel is written while it is being read, so neither the stack nor a decoded channel has
+# to be held on disk or in memory. Channels are split in parallel
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import io
+import logging
+import math
+import os
+import tempfile
+
+import numpy as np
+import requests
+import tifffile #type: ignore
+
+from cdb_cellmaps._config import Config as _Config
+
+# Tile size of the written channels
+TILE_SIZE = int(os.getenv('SPLITTER_TILE_SIZE', 512))
+# Number of channels split concurrently
+SPLITTER_WORKERS = int(os.getenv('SPLITTER_WORKERS', min(8, os.cpu_count() or 1)))
+# Maximum number of reduced resolution levels stored with each channel (0 for none)
+PYRAMID_LEVELS = int(os.getenv('SPLITTER_PYRAMID_LEVELS', 8))
+# Segments of the stack closer together than this are fetched with a single read
+COALESCE_GAP = 1 << 20
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object over a url which supports range requests (such as a presigned minio url),
+    each read is a ranged GET, so only the bytes which are actually needed are transferred.
+    """
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session or requests.Session()
+        self.position = 0
+        # The size of the object, from the Content-Range of a one byte request (a HEAD isn't valid for a presigned GET)
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            r.raise_for_status()
+            self.size = int(r.headers['Content-Range'].split('/')[-1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.position)
+        if n <= 0:
+            return 0
+        r = self.session.get(self.url, headers={'Range': f'bytes={self.position}-{self.position + n - 1}'})
+        r.raise_for_status()
+        data = r.content
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+@contextmanager
+def open_stack(source):
+    # source is a local path or a url, urls are read with ranged requests rather than downloaded
+    if os.path.exists(source) or not str(source).startswith(('http://', 'https://')):
+        with tifffile.TiffFile(source) as tf:
+            yield tf
+    else:
+        with io.BufferedReader(HTTPRangeFile(source), buffer_size=COALESCE_GAP) as fh, tifffile.TiffFile(fh) as tf:
+            yield tf
+
+
+def segment_shape(page):
+    # Height and width of the strips / tiles the page is stored in
+    if page.is_tiled:
+        return page.tilelength, page.tilewidth
+    return min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+
+
+def read_segments(page, indices):
+    # Raw bytes of the given segments, segments which are close together in the file are fetched with one read
+    fh = page.parent.filehandle
+    order = sorted((i for i in indices if page.databytecounts[i] > 0), key=lambda i: page.dataoffsets[i])
+    data = {}
+    start = 0
+    while start < len(order):
+        stop = start + 1
+        while stop < len(order) and page.dataoffsets[order[stop]] - (page.dataoffsets[order[stop - 1]] + page.databytecounts[order[stop - 1]]) < COALESCE_GAP:
+            stop += 1
+        first = page.dataoffsets[order[start]]
+        last = page.dataoffsets[order[stop - 1]] + page.databytecounts[order[stop - 1]]
+        with fh.lock:
+            fh.seek(first)
+            chunk = fh.read(last - first)
+        for i in order[start:stop]:
+            data[i] = chunk[page.dataoffsets[i] - first:page.dataoffsets[i] - first + page.databytecounts[i]]
+        start = stop
+    return data
+
+
+def read_band(page, top, height):
+    # Full width band of rows [top:top+height] of a single channel page, decoding only the segments it intersects
+    height = min(height, page.imagelength - top)
+    out = np.zeros((height, page.imagewidth), dtype=page.dtype)
+    seg_h, seg_w = segment_shape(page)
+    segments_across = -(-page.imagewidth // seg_w)
+    first_row, last_row = top // seg_h, (top + height - 1) // seg_h
+    indices = [r * segments_across + c for r in range(first_row, last_row + 1) for c in range(segments_across)]
+    for index, data in read_segments(page, indices).items():
+        segment, (_, _, seg_top, seg_left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+        if segment is None:
+            # Empty segments are implicitly zero
+            continue
+        segment = segment[0, :, :, 0]
+        r0, r1 = max(seg_top, top), min(seg_top + segment.shape[0], top + height)
+        c1 = min(seg_left + segment.shape[1], page.imagewidth)
+        out[r0 - top:r1 - top, seg_left:c1] = segment[r0 - seg_top:r1 - seg_top, :c1 - seg_left]
+    return out
+
+
+def iter_bands(page, tile_size=TILE_SIZE, align=1):
+    # Yields (top, band) for full width bands of the page, one band is held in memory at a time
+    # Bands are a whole number of tile rows and at least as tall as a source strip, so each strip is decoded about once
+    # Band heights are also a multiple of align (2 ** the number of pyramid levels, see fill_pyramid)
+    step = math.lcm(tile_size, align)
+    band_height = step * -(-segment_shape(page)[0] // step)
+    for top in range(0, page.imagelength, band_height):
+        yield top, read_band(page, top, band_height)
+
+
+def iter_tiles(bands, width, tile_size=TILE_SIZE):
+    # Yields the tiles of the bands in the order tifffile writes them
+    for _, band in bands:
+        for top in range(0, band.shape[0], tile_size):
+            for left in range(0, width, tile_size):
+                tile = np.zeros((tile_size, tile_size), dtype=band.dtype)
+                part = band[top:top + tile_size, left:left + tile_size]
+                tile[:part.shape[0], :part.shape[1]] = part
+                yield tile
+
+
+def pyramid_shapes(shape):
+    # Shapes of the reduced resolution levels, each half the size of the previous one (rounded up)
+    # down to the first level which fits in a single tile
+    shapes = []
+    while len(shapes) < PYRAMID_LEVELS and max(shape) > TILE_SIZE:
+        shape = (-(-shape[0] // 2), -(-shape[1] // 2))
+        shapes.append(shape)
+    return shapes
+
+
+def downsample(band):
+    # 2x2 mean (rounded), odd edges are averaged with a copy of themselves
+    padded = np.pad(band, ((0, band.shape[0] % 2), (0, band.shape[1] % 2)), mode='edge').astype(np.uint64)
+    summed = padded[0::2, 0::2] + padded[1::2, 0::2] + padded[0::2, 1::2] + padded[1::2, 1::2]
+    return ((summed + 2) // 4).astype(band.dtype)
+
+
+def fill_pyramid(bands, levels):
+    # Passes the bands through, writing each band's reduced versions into the levels (arrays) as it goes
+    # Bands are a multiple of 2 ** len(levels) rows (all but the last), so each reduced band starts at top >> level
+    # (before the band is yielded, as the consumer doesn't resume the generator after the last tile)
+    for top, band in bands:
+        assert top % (1 << len(levels)) == 0, f'band at row {top} is not aligned to {1 << len(levels)} rows'
+        reduced = band
+        for k, level in enumerate(levels, start=1):
+            reduced = downsample(reduced)
+            level[top >> k:(top >> k) + reduced.shape[0]] = reduced
+        yield top, band
+
+
+def write_channel(page, path):
+    # Tiled, zlib compressed OME-TIFF (a single YX image in the OME-XML), with the reduced resolution levels as
+    # SubIFDs of the full resolution image
+    # The levels are built from the full resolution bands while they're written, in memory mapped scratch files
+    shapes = pyramid_shapes(page.shape)
+    bigtiff = page.size * page.dtype.itemsize * 4 // 3 > 2 ** 32 - 2 ** 25
+    with tempfile.TemporaryDirectory() as scratch, tifffile.TiffWriter(path, bigtiff=bigtiff, ome=True) as tif:
+        levels = [
+            np.lib.format.open_memmap(os.path.join(scratch, f'level-{k}.npy'), mode='w+', dtype=page.dtype, shape=shape)
+            for k, shape in enumerate(shapes, start=1)
+        ]
+        bands = fill_pyramid(iter_bands(page, align=1 << len(levels)), levels)
+        tif.write(iter_tiles(bands, page.imagewidth), shape=page.shape, dtype=page.dtype, tile=(TILE_SIZE, TILE_SIZE),
+                  compression='zlib', subifds=len(levels), metadata={'axes': 'YX'})
+        for level in levels:
+            tif.write(level, tile=(TILE_SIZE, TILE_SIZE), compression='zlib', subfiletype=1)
+
+
+def publish_channel(cls, source, page_index, prefix, file_name):
+    # Streams one page of the stack into a tiled TIFF and stores it the same way cls.write would (locally in debug,
+    # in the workflow bucket otherwise), returns an instance of cls pointing at it
+    with open_stack(source) as tf:
+        page = tf.pages[page_index]
+        if _Config.DEBUG():
+            os.makedirs(prefix[1:], exist_ok=True)
+            path = os.path.join(prefix[1:], file_name + cls.FILE_EXTENSION)
+            write_channel(page, path)
+            return cls(url=os.path.abspath(path))
+
+        from cdb_cellmaps._utils import get_minio_client
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, file_name + cls.FILE_EXTENSION)
+            write_channel(page, path)
+            client = get_minio_client()
+            object_name = f"{prefix}{file_name}{cls.FILE_EXTENSION}"
+            client.fput_object(
+                bucket_name=_Config._MINIO_WORKFLOW_BUCKET,
+                object_name=object_name,
+                file_path=path,
+                num_parallel_uploads=_Config._MINIO_NUM_PARALLEL_UPLOADS)
+            return cls(url=client.get_presigned_url('GET', _Config._MINIO_WORKFLOW_BUCKET, object_name))
+
+
+def channel_shapes(source, n_channels):
+    with open_stack(source) as tf:
+        return [tf.pages[i].shape for i in range(n_channels)]
+
+
+def split_channels(cls, source, channel_names, prefix, workers=SPLITTER_WORKERS):
+    # Splits the first len(channel_names) pages of the stack into channels, returns {channel_name: cls}
+    # Each worker opens the stack itself, so reads (and ranged requests) of different channels run concurrently
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            channel_name: executor.submit(publish_channel, cls, source, i, prefix, channel_name)
+            for i, channel_name in enumerate(channel_names)
+        }
+        written = {}
+        for channel_name, future in futures.items():
+            written[channel_name] = future.result()
+            logging.warning(f'{channel_name} written ({len(written)}/{len(futures)})')
+        return written
@@ -7,6 +7,8 @@ import requests
 
 import tifffile #type: ignore
 
+import channel_splitter #type: ignore
+
 from cdb_cellmaps.data import MembraneMarkers, NuclearMarkers, NuclearStain, ProteinChannelMarker, ProteinChannelMarkers, WholeSlideImage, WholeSlideImageProteinChannel
 from cdb_cellmaps import data_utils
 from cdb_cellmaps.process import Interactive, Start
@@ -15,7 +17,6 @@ from cdb_cellmaps._config import Config as _Config
 
 
 if _Config.DEBUG() == False:
-    from cdb_cellmaps._utils import download_stacked_tiff_locally
     from cdb_cellmaps._raw_data import RAW_WSI,read_raw_data,get_experiment_data_urls
 else:
     from cdb_cellmaps._cli_utils import TestGenerator
@@ -126,9 +127,8 @@ class InitWSI(Start,Interactive):
                 prefix_name=input.workflow_parameters.experiment_data_id+'/',)
 
 
-            # Save the Tiff stack locally
-            large_tiff_local_dir  = download_stacked_tiff_locally(urls['tiff_name'])
-            logging.warning(f"LOCAL NAME :{large_tiff_local_dir}")
+            # The Tiff stack is read straight from the object storage (with ranged requests), it isn't downloaded
+            stack_source = urls['tiff_name']
         
             # Get & Parse Channel Markers txt file and add to points
             response = requests.get(urls['channel_markers'])
@@ -143,33 +143,22 @@ class InitWSI(Start,Interactive):
             protein_channel_markers.append(ProteinChannelMarker('A0'))
             # generate a mock tiff file
             import numpy as np
-            large_tiff_local_dir = 'tf.ome.tiff'
-            tifffile.imwrite(large_tiff_local_dir,np.array(TestGenerator.random_image_8bit()), compression='zlib')
+            stack_source = 'tf.ome.tiff'
+            tifffile.imwrite(stack_source,np.array(TestGenerator.random_image_8bit()), compression='zlib')
             
 
-        # Use tifffile to partially read the Tiff file
-        tf = tifffile.TiffFile(large_tiff_local_dir)
-
-        channel_shapes = []
-        temp = WholeSlideImage()
-
-        for i,p_chan in enumerate(protein_channel_markers):
-            p_channel_tiff = tf.pages[i]
-            channel_shapes.append(p_channel_tiff.shape)
-            # Need to come up with a means of getting the prefix in
-            temp[p_chan] = WholeSlideImageProteinChannel.write(
-                Image.fromarray(p_channel_tiff.asarray()),
-                prefix=prefix,
-                file_name=p_chan)
-
-        
-        # Santity Check, ensure that all the protein channels written to the object storage are the same dimension
+        # Santity Check, ensure that all the protein channels are the same dimension before any are written
+        channel_shapes = channel_splitter.channel_shapes(stack_source, len(protein_channel_markers))
         assert len(set(channel_shapes)) == 1, 'Not all the selected Images are off the same Dimension, is the Marker List correct?'
 
+        # Split the pages of the Tiff stack into tiled grayscale tiffs, streaming and in parallel
+        temp = WholeSlideImage()
+        for p_chan, channel in channel_splitter.split_channels(WholeSlideImageProteinChannel, stack_source, protein_channel_markers, prefix).items():
+            temp[p_chan] = channel
 
-        # Deleting the locally stored instance of the full size image
-        tf.close()
-        os.remove(large_tiff_local_dir)
+        if _Config.DEBUG():
+            # Deleting the mock tiff stack
+            os.remove(stack_source)
 
         return InitWSIProcessOutput(
             data=InitWSIProcessOutput.Data(
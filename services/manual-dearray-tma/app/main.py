@@ -10,6 +10,8 @@ from cdb_cellmaps.process import DeArray, Interactive
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
+import pyramid #type: ignore
+
 
 # What comes from the execution environment
 @dataclass
@@ -74,13 +76,12 @@ class ManualDearrayTMA(DeArray,Interactive):
     def prepare_template(self, prefix, submit_url, input: ManualDearrayTMAPrepareTemplateInput) -> ManualDearrayTMAPrepareTemplateOutput:
         template = self.env.get_template("de_array_manual.html")
 
-        # Load Nuclear Stain Image
-        nuclear_stain_img = input.data.tissue_micro_array[input.workflow_parameters.nuclear_stain].read()
+        # Load the Nuclear Stain Image, reduced by 5x so it doesn't blow the browser !
+        # (from the channel's stored pyramid levels, rather than the full size image)
+        nuclear_stain_img = pyramid.read_downsampled(input.data.tissue_micro_array[input.workflow_parameters.nuclear_stain], factor=5)
 
-        
-        # Reduce the size of the raw image by 5x so it doesn't blow the browser !
         png = PNG.write(
-            nuclear_stain_img.reduce(factor=5),
+            nuclear_stain_img,
             prefix=prefix.add_level('browser-images'),
             file_name=input.workflow_parameters.nuclear_stain)
         
@@ -0,0 +1,130 @@
+# Level / region reads of protein channels stored as tiled, pyramidal TIFFs (see init-tma's channel_splitter)
+# Only the tiles of the requested level and region are fetched (with ranged requests for remote channels) and decoded
+# Channels without stored levels are still readable, levels are then computed from the full resolution image
+from contextlib import contextmanager
+import io
+import math
+import os
+
+import numpy as np
+import requests
+import tifffile #type: ignore
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = None
+
+from cdb_cellmaps._config import Config as _Config
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    Read only, seekable file object over a url which supports range requests (such as a presigned minio url),
+    each read is a ranged GET, so only the bytes which are actually needed are transferred.
+    """
+    def __init__(self, url, session=None):
+        self.url = url
+        self.session = session or requests.Session()
+        self.position = 0
+        # The size of the object, from the Content-Range of a one byte request (a HEAD isn't valid for a presigned GET)
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True) as r:
+            r.raise_for_status()
+            self.size = int(r.headers['Content-Range'].split('/')[-1])
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.position = offset
+        elif whence == io.SEEK_CUR:
+            self.position += offset
+        elif whence == io.SEEK_END:
+            self.position = self.size + offset
+        return self.position
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.size - self.position)
+        if n <= 0:
+            return 0
+        r = self.session.get(self.url, headers={'Range': f'bytes={self.position}-{self.position + n - 1}'})
+        r.raise_for_status()
+        data = r.content
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+
+@contextmanager
+def open_channel(file):
+    # In debug mode the url is a local path, otherwise the object is read with ranged requests rather than downloaded
+    if _Config.DEBUG() or os.path.exists(file.url):
+        with tifffile.TiffFile(file.url) as tf:
+            yield tf
+    else:
+        with io.BufferedReader(HTTPRangeFile(file.url), buffer_size=1 << 20) as fh, tifffile.TiffFile(fh) as tf:
+            yield tf
+
+
+def levels(tf):
+    # Pages of the full resolution image and its stored reduced resolution levels, largest first
+    return [level.keyframe for level in tf.series[0].levels]
+
+
+def read_region(page, top, left, height, width):
+    # The window [top:top+height, left:left+width] of a single channel page, decoding only the tiles it intersects
+    # Areas of the window outside of the image are zero filled (the same as PIL's crop)
+    out = np.zeros((height, width), dtype=page.dtype)
+    row_start, row_stop = max(top, 0), min(top + height, page.imagelength)
+    col_start, col_stop = max(left, 0), min(left + width, page.imagewidth)
+    if row_start >= row_stop or col_start >= col_stop:
+        return out
+
+    if page.is_tiled:
+        seg_h, seg_w = page.tilelength, page.tilewidth
+    else:
+        seg_h, seg_w = min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+    segments_across = -(-page.imagewidth // seg_w)
+    fh = page.parent.filehandle
+
+    for seg_row in range(row_start // seg_h, (row_stop - 1) // seg_h + 1):
+        for seg_col in range(col_start // seg_w, (col_stop - 1) // seg_w + 1):
+            index = seg_row * segments_across + seg_col
+            with fh.lock:
+                fh.seek(page.dataoffsets[index])
+                data = fh.read(page.databytecounts[index])
+            segment, (_, _, seg_top, seg_left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if segment is None:
+                # Empty segments are implicitly zero
+                continue
+            segment = segment[0, :, :, 0]
+            r0, r1 = max(seg_top, row_start), min(seg_top + segment.shape[0], row_stop)
+            c0, c1 = max(seg_left, col_start), min(seg_left + segment.shape[1], col_stop)
+            if r0 < r1 and c0 < c1:
+                out[r0 - top:r1 - top, c0 - left:c1 - left] = segment[r0 - seg_top:r1 - seg_top, c0 - seg_left:c1 - seg_left]
+    return out
+
+
+def read_level(file, level):
+    # A whole stored level of the channel as a PIL image (0 is the full resolution image)
+    with open_channel(file) as tf:
+        page = levels(tf)[level]
+        return Image.fromarray(read_region(page, 0, 0, page.imagelength, page.imagewidth))
+
+
+def read_downsampled(file, factor):
+    # The channel reduced by factor, for previews. Built from the smallest stored level which is still at least
+    # as large as the result, so the full resolution image is only decoded when no suitable level is stored
+    with open_channel(file) as tf:
+        pages = levels(tf)
+        height, width = pages[0].shape
+        size = (math.ceil(width / factor), math.ceil(height / factor))
+        page = [p for p in pages if p.imagewidth >= size[0] and p.imagelength >= size[1]][-1]
+        if page is pages[0]:
+            return Image.fromarray(read_region(page, 0, 0, height, width)).reduce(factor=factor)
+        level = Image.fromarray(read_region(page, 0, 0, page.imagelength, page.imagewidth))
+        return level.resize(size, resample=Image.BOX)
@@ -1,5 +1,8 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from dataclasses import dataclass
 from enum import Enum
+import logging
+import os
 
 from cdb_cellmaps.data import DearrayedTissueMicroArray, DearrayedTissueMicroArrayCellSegmentationMask, DearrayedTissueMicroArrayMissileFCS, NuclearMarkers, ProteinChannelMarkers, TissueCoreMissileFCS
 from cdb_cellmaps import data_utils
@@ -11,7 +14,12 @@ from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
 from to_tabular_format import * #type: ignore
+import mask_io #type: ignore
 
+# Number of cores extracted in parallel, 1 runs every core serially in this process
+EXTRACTION_WORKERS = int(os.getenv('XTRACIT_WORKERS', os.cpu_count() or 1))
+# Share of the available memory the workers may use between them, caps the number of cores in flight
+MEMORY_FRACTION = float(os.getenv('XTRACIT_MEMORY_FRACTION', 0.75))
 
 
 # DTMA , CellSegmentationMASKS, Nuclear Markers
@@ -70,64 +78,112 @@ class XtracitDTMA(FeatureExtraction,Automated):
         # What do with channel markers?
         # Typing of this is wrong -> Need to fix it
         membrane_channels = [c for c in input.workflow_parameters.protein_channel_markers if c not in input.workflow_parameters.nuclear_markers]
+        nuclear_markers = input.workflow_parameters.nuclear_markers.encode()
+        cores = list(input.data.dearrayed_tissue_micro_array.items())
+        masks = input.data.dearrayed_tissue_micro_array_cell_segmentation_masks
+
+        workers = concurrency_limit(cores, masks, len(membrane_channels) + len(nuclear_markers))
+        logging.warning(f'Extracting {len(cores)} cores with {workers} worker(s)')
+
+        written = {}
+        if workers == 1:
+            for core_name, core in cores:
+                written[core_name] = extract_core(core_name, core, masks[core_name], membrane_channels, nuclear_markers, prefix)
+        else:
+            # Each worker writes its TissueCoreMissileFCS as soon as the core is finished
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(extract_core, core_name, core, masks[core_name], membrane_channels, nuclear_markers, prefix): core_name
+                    for core_name, core in cores
+                }
+                for future in as_completed(futures):
+                    written[futures[future]] = future.result()
+                    logging.warning(f'{futures[future]} extracted ({len(written)}/{len(cores)})')
+
+        # Assemble the output in input order, so it doesn't depend on the order the workers finished in
         temp = DearrayedTissueMicroArrayMissileFCS()
+        for core_name, _ in cores:
+            temp[core_name] = written[core_name]
 
-        for core_name, core in input.data.dearrayed_tissue_micro_array.items():
-            
-               
-            # Creating the membrane channel stack
-            all_membrane_protein_channels = []
-
-            for channel in membrane_channels:
-                all_membrane_protein_channels.append(np.array(core[channel].read()))
-
-            membrane_protein_channel_stack = np.stack(all_membrane_protein_channels,axis=2)
-            membrane_mask = np.array(input.data.dearrayed_tissue_micro_array_cell_segmentation_masks[core_name].membrane_mask.read())
-
-            membrane_df = extract_membrane_for_core(membrane_mask,
-                                membrane_protein_channel_stack,
-                                core_name,
-                                membrane_channels)
-            # Delete from memory
-            del membrane_protein_channel_stack, membrane_mask
-
-            nucleus_mask = np.array(input.data.dearrayed_tissue_micro_array_cell_segmentation_masks[core_name].nucleus_mask.read())
-
-            # Create nuclear channel stack
-            all_nuclear_protein_channels = []
-            for channel in input.workflow_parameters.nuclear_markers:
-                all_nuclear_protein_channels.append(np.array(core[channel].read()))
-            
-            # W x H x NUMBER_OF_PROTEIN_CHANNELS 
-            nuclear_protein_channel_stack = np.stack(all_nuclear_protein_channels,axis=2)
-            nuclear_df = extract_nucelus_for_core(
-                nucleus_mask,
-                nuclear_protein_channel_stack,
-                core_name,
-                input.workflow_parameters.nuclear_markers.encode())
-            
-
-            # delete from memory
-            del nuclear_protein_channel_stack, nucleus_mask
-
-            final_df = get_final_dataframe(membrane_df,nuclear_df)
-
-            # Todo: Correct Prefix
-            temp[core_name] = TissueCoreMissileFCS.write(
-                final_df,
-                prefix=prefix,
-                file_name=core_name,
-            )
-
-            
-
-        
         return XtracitDTMAProcessOutput(
             XtracitDTMAProcessOutput.Data(
                 dearrayed_tissue_micro_array_missile_fcs= temp
             )
           
         )
-    
+
+
+def extract_core(core_name, core, core_masks, membrane_channels, nuclear_markers, prefix) -> TissueCoreMissileFCS:
+    # Creating the membrane channel stack
+    all_membrane_protein_channels = []
+
+    for channel in membrane_channels:
+        all_membrane_protein_channels.append(np.array(core[channel].read()))
+
+    membrane_protein_channel_stack = np.stack(all_membrane_protein_channels,axis=2)
+    membrane_mask = mask_io.read_mask(core_masks.membrane_mask)
+
+    membrane_df = extract_membrane_for_core(membrane_mask,
+                        membrane_protein_channel_stack,
+                        core_name,
+                        membrane_channels)
+    # Delete from memory
+    del membrane_protein_channel_stack, membrane_mask
+
+    nucleus_mask = mask_io.read_mask(core_masks.nucleus_mask)
+
+    # Create nuclear channel stack
+    all_nuclear_protein_channels = []
+    for channel in nuclear_markers:
+        all_nuclear_protein_channels.append(np.array(core[channel].read()))
+
+    # W x H x NUMBER_OF_PROTEIN_CHANNELS 
+    nuclear_protein_channel_stack = np.stack(all_nuclear_protein_channels,axis=2)
+    nuclear_df = extract_nucelus_for_core(
+        nucleus_mask,
+        nuclear_protein_channel_stack,
+        core_name,
+        nuclear_markers)
+
+    # delete from memory
+    del nuclear_protein_channel_stack, nucleus_mask
+
+    final_df = get_final_dataframe(membrane_df,nuclear_df)
+
+    # Todo: Correct Prefix
+    return TissueCoreMissileFCS.write(
+        final_df,
+        prefix=prefix,
+        file_name=core_name,
+    )
+
+
+def available_memory() -> int:
+    # Memory available to this container, the cgroup limit takes precedence over the free memory of the node
+    available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    for limit_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            if limit != 'max':
+                available = min(available, int(limit))
+            break
+        except (OSError, ValueError):
+            continue
+    return available
+
+
+def concurrency_limit(cores, masks, n_channels) -> int:
+    workers = max(1, min(EXTRACTION_WORKERS, len(cores)))
+    if workers == 1:
+        return 1
+    # Estimate the peak memory of one core from the size of the first core's mask (cores are of a similar size)
+    # int64 label image, its regionprops working copies, a float64 channel copy and the uint8 channel stack
+    with mask_io.open_mask(masks[cores[0][0]].membrane_mask) as tf:
+        height, width = tf.series[0].shape
+    per_core = width * height * (3 * 8 + 8 + n_channels)
+    return max(1, min(workers, int(available_memory() * MEMORY_FRACTION) // per_core))
+
+
 if __name__ == '__main__':
     XtracitDTMA().run()
\ No newline at end of file
@@ -1,6 +1,7 @@
 from dataclasses import dataclass
 from enum import Enum
 import logging
+import os
 
 from cdb_cellmaps.data import  NuclearMarkers, ProteinChannelMarkers, WholeSlideImage, WholeSlideImageCellSegmentationMask, WholeSlideImageMissileFCS
 from cdb_cellmaps import data_utils
@@ -11,8 +12,12 @@ import numpy as np
 from PIL import Image
 Image.MAX_IMAGE_PIXELS = None
 
+import mask_io #type: ignore
 import to_tabular_format #type: ignore
+import tiled_extraction #type: ignore
 
+# 'streaming' reads the masks and channels band by band, 'in-memory' loads the full slide (the original behaviour)
+EXTRACTION_MODE = os.getenv('XTRACIT_EXTRACTION_MODE', 'streaming')
 
 
 # DTMA , CellSegmentationMASKS, Nuclear Markers
@@ -69,8 +74,40 @@ class XtracitWSI(FeatureExtraction,Automated):
         # What do with channel markers?
         membrane_channels = [c for c in input.workflow_parameters.protein_channel_markers if c not in input.workflow_parameters.nuclear_markers]
 
+        if EXTRACTION_MODE == 'streaming':
+            # Peak memory depends on the band size, not on the size of the slide
+            membrane_df = tiled_extraction.extract_membrane_for_slide(
+                input.data.whole_slide_image_cell_segmentation_mask.membrane_mask,
+                [input.data.whole_slide_image[channel] for channel in membrane_channels],
+                "A0",
+                membrane_channels)
+            nuclear_df = tiled_extraction.extract_nucleus_for_slide(
+                input.data.whole_slide_image_cell_segmentation_mask.nucleus_mask,
+                [input.data.whole_slide_image[channel] for channel in input.workflow_parameters.nuclear_markers],
+                "A0",
+                input.workflow_parameters.nuclear_markers.encode())
+        else:
+            membrane_df, nuclear_df = self._extract_in_memory(input, membrane_channels)
 
-        membrane_mask = np.array(input.data.whole_slide_image_cell_segmentation_mask.membrane_mask.read())
+        final_df = to_tabular_format.get_final_dataframe(membrane_df,nuclear_df)
+
+        # Todo: fix prefix
+        temp = WholeSlideImageMissileFCS.write(final_df,
+                                                prefix=prefix,
+                                                file_name="AO")
+
+
+        
+        return XtracitWSIProcessOutput(
+            XtracitWSIProcessOutput.Data(
+              whole_slide_image_missile_fcs=temp
+            )
+          
+        )
+
+    def _extract_in_memory(self, input: XtracitWSIProcessInput, membrane_channels):
+
+        membrane_mask = mask_io.read_mask(input.data.whole_slide_image_cell_segmentation_mask.membrane_mask)
         # Creating the membrane channel stack
         all_membrane_protein_channels = []
 
@@ -87,7 +124,7 @@ class XtracitWSI(FeatureExtraction,Automated):
         # Delete from memory
         del membrane_protein_channel_stack, membrane_mask
 
-        nucleus_mask = np.array(input.data.whole_slide_image_cell_segmentation_mask.nucleus_mask.read())
+        nucleus_mask = mask_io.read_mask(input.data.whole_slide_image_cell_segmentation_mask.nucleus_mask)
 
         # Create nuclear channel stack
         all_nuclear_protein_channels = []
@@ -107,21 +144,7 @@ class XtracitWSI(FeatureExtraction,Automated):
         # delete from memory
         del nuclear_protein_channel_stack, nucleus_mask
 
-        final_df = to_tabular_format.get_final_dataframe(membrane_df,nuclear_df)
-
-        # Todo: fix prefix
-        temp = WholeSlideImageMissileFCS.write(final_df,
-                                                prefix=prefix,
-                                                file_name="AO")
-
-
-        
-        return XtracitWSIProcessOutput(
-            XtracitWSIProcessOutput.Data(
-              whole_slide_image_missile_fcs=temp
-            )
-          
-        )
+        return membrane_df, nuclear_df
     
 
 if __name__ == '__main__':
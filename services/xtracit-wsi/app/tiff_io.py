@@ -0,0 +1,68 @@
+# Helpers for reading regions of large TIFFs without decoding the whole page
+# Only the strips / tiles which intersect the requested region are read and decoded
+from contextlib import contextmanager
+import os
+
+import numpy as np
+
+from cdb_cellmaps._config import Config as _Config
+
+
+@contextmanager
+def local_tiff_path(file):
+    # In debug mode the url is already a local path, otherwise stage the object to local disk for random access
+    if _Config.DEBUG() or os.path.exists(file.url):
+        yield file.url
+    else:
+        from cdb_cellmaps._utils import download_stacked_tiff_locally
+        local_path = download_stacked_tiff_locally(file.url)
+        try:
+            yield local_path
+        finally:
+            os.remove(local_path)
+
+
+def segment_shape(page):
+    # Height and width of the strips / tiles the page is stored in
+    if page.is_tiled:
+        return page.tilelength, page.tilewidth
+    return min(page.rowsperstrip or page.imagelength, page.imagelength), page.imagewidth
+
+
+def read_region(page, top, left, height, width):
+    # Read the window [top:top+height, left:left+width] of a single channel page
+    # Areas of the window outside of the image are zero filled (the same as PIL's crop)
+    out = np.zeros((height, width), dtype=page.dtype)
+    row_start, row_stop = max(top, 0), min(top + height, page.imagelength)
+    col_start, col_stop = max(left, 0), min(left + width, page.imagewidth)
+    if row_start >= row_stop or col_start >= col_stop:
+        return out
+
+    seg_h, seg_w = segment_shape(page)
+    segments_across = -(-page.imagewidth // seg_w)
+    fh = page.parent.filehandle
+
+    for seg_row in range(row_start // seg_h, (row_stop - 1) // seg_h + 1):
+        for seg_col in range(col_start // seg_w, (col_stop - 1) // seg_w + 1):
+            index = seg_row * segments_across + seg_col
+            with fh.lock:
+                fh.seek(page.dataoffsets[index])
+                data = fh.read(page.databytecounts[index])
+            segment, (_, _, seg_top, seg_left, _), _ = page.decode(data, index, jpegtables=page.jpegtables)
+            if segment is None:
+                # Empty segments are implicitly zero
+                continue
+            segment = segment[0, :, :, 0]
+            # Intersect the segment with the requested window
+            r0, r1 = max(seg_top, row_start), min(seg_top + segment.shape[0], row_stop)
+            c0, c1 = max(seg_left, col_start), min(seg_left + segment.shape[1], col_stop)
+            if r0 < r1 and c0 < c1:
+                out[r0 - top:r1 - top, c0 - left:c1 - left] = segment[r0 - seg_top:r1 - seg_top, c0 - seg_left:c1 - seg_left]
+    return out
+
+
+def iter_row_bands(page, band_height, start=0, stop=None):
+    # Yields (top, band) for full width bands of rows, so only one band is held in memory at a time
+    stop = page.imagelength if stop is None else min(stop, page.imagelength)
+    for top in range(start, stop, band_height):
+        yield top, read_region(page, top, 0, min(band_height, stop - top), page.imagewidth)
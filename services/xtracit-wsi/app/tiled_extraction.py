@@ -0,0 +1,183 @@
+# Out-of-core feature extraction for whole slide images
+# The masks and protein channels are read in bands of rows, per-label sums are accumulated across the bands
+# so peak memory depends on the band size rather than on the size of the slide
+from contextlib import ExitStack
+import os
+
+import numpy as np
+import pandas as pd
+import tifffile
+from skimage.measure import regionprops_table
+
+import to_tabular_format #type: ignore
+from tiff_io import iter_row_bands, local_tiff_path, read_region #type: ignore
+
+# Number of rows of the slide held in memory at a time
+BAND_HEIGHT = int(os.getenv('XTRACIT_BAND_HEIGHT', 512))
+
+# regionprops which depend on the shape of the whole cell, these are only valid for cells which fit in one band
+MORPHOLOGY_PROPERTIES = ['perimeter', 'major_axis_length', 'minor_axis_length', 'eccentricity', 'solidity', 'equivalent_diameter']
+
+
+class LabelAccumulator():
+    """
+    Accumulates per-label pixel counts, coordinate sums, bounding boxes and channel intensity sums
+    over the bands of a label image. Arrays are indexed directly by label and grow as larger labels are seen.
+    Cells which straddle band borders are merged because their sums are simply added together, shape properties
+    for those cells are computed afterwards from their reassembled bounding box (see fix_morphology).
+    """
+    def __init__(self, n_channels, morphology=False):
+        self.n_channels = n_channels
+        self.area_dtype = np.float64
+        self.capacity = 0
+        self.count = np.zeros(0, dtype=np.int64)
+        # Coordinate sums are integers, so the centroids are exact (the same as regionprops)
+        self.sum_row = np.zeros(0, dtype=np.float64)
+        self.sum_col = np.zeros(0, dtype=np.float64)
+        self.min_row = np.zeros(0, dtype=np.int64)
+        self.min_col = np.zeros(0, dtype=np.int64)
+        self.max_row = np.zeros(0, dtype=np.int64)
+        self.max_col = np.zeros(0, dtype=np.int64)
+        self.bands_seen = np.zeros(0, dtype=np.int64)
+        self.touches_seam = np.zeros(0, dtype=bool)
+        self.channel_sums = np.zeros((0, n_channels), dtype=np.float64)
+        self.shape_props = {p: np.zeros(0, dtype=np.float64) for p in (MORPHOLOGY_PROPERTIES if morphology else [])}
+
+    def _reserve(self, max_label):
+        if max_label < self.capacity:
+            return
+        new_capacity = max(max_label + 1, 2 * self.capacity)
+        pad = new_capacity - self.capacity
+        int_max = np.iinfo(np.int64).max
+        self.count = np.concatenate([self.count, np.zeros(pad, dtype=np.int64)])
+        self.sum_row = np.concatenate([self.sum_row, np.zeros(pad)])
+        self.sum_col = np.concatenate([self.sum_col, np.zeros(pad)])
+        self.min_row = np.concatenate([self.min_row, np.full(pad, int_max)])
+        self.min_col = np.concatenate([self.min_col, np.full(pad, int_max)])
+        self.max_row = np.concatenate([self.max_row, np.zeros(pad, dtype=np.int64)])
+        self.max_col = np.concatenate([self.max_col, np.zeros(pad, dtype=np.int64)])
+        self.bands_seen = np.concatenate([self.bands_seen, np.zeros(pad, dtype=np.int64)])
+        self.touches_seam = np.concatenate([self.touches_seam, np.zeros(pad, dtype=bool)])
+        self.channel_sums = np.concatenate([self.channel_sums, np.zeros((pad, self.n_channels))])
+        for p in self.shape_props:
+            self.shape_props[p] = np.concatenate([self.shape_props[p], np.zeros(pad)])
+        self.capacity = new_capacity
+
+    def add_mask_band(self, top, band, is_last_band):
+        # Region properties of the cells in this band, moments are relative to each cell's bounding box
+        props = regionprops_table(band, properties=['label', 'area', 'bbox', 'moments'] + list(self.shape_props))
+        labels = props['label']
+        if len(labels) == 0:
+            return
+        self.area_dtype = props['area'].dtype
+        self._reserve(int(labels.max()))
+
+        bbox_top = props['bbox-0'] + top
+        bbox_left = props['bbox-1']
+        bbox_bottom = props['bbox-2'] + top
+        bbox_right = props['bbox-3']
+        count = np.round(props['moments-0-0']).astype(np.int64)
+        # Translate the bounding box relative first order moments into sums of slide coordinates
+        self.count[labels] += count
+        self.sum_row[labels] += props['moments-1-0'] + count * bbox_top
+        self.sum_col[labels] += props['moments-0-1'] + count * bbox_left
+        self.min_row[labels] = np.minimum(self.min_row[labels], bbox_top)
+        self.min_col[labels] = np.minimum(self.min_col[labels], bbox_left)
+        self.max_row[labels] = np.maximum(self.max_row[labels], bbox_bottom)
+        self.max_col[labels] = np.maximum(self.max_col[labels], bbox_right)
+        self.bands_seen[labels] += 1
+
+        # Cells which touch the top or bottom of a band (other than the edges of the slide) may continue in the next band
+        seam = np.zeros(len(labels), dtype=bool)
+        if top > 0:
+            seam |= props['bbox-0'] == 0
+        if not is_last_band:
+            seam |= props['bbox-2'] == band.shape[0]
+        self.touches_seam[labels] |= seam
+        for p in self.shape_props:
+            self.shape_props[p][labels] = props[p]
+
+    def add_channel_band(self, band_labels, channel_band, channel_index):
+        flat_labels = band_labels.ravel()
+        n_bins = int(flat_labels.max()) + 1 if flat_labels.size else 1
+        self._reserve(n_bins - 1)
+        self.channel_sums[:n_bins, channel_index] += np.bincount(flat_labels, weights=channel_band.ravel(), minlength=n_bins)
+
+    def needs_fixing(self):
+        # Cells which were split across bands, their shape properties have to be computed from the whole cell
+        return np.nonzero((self.count > 0) & (self.touches_seam | (self.bands_seen > 1)))[0]
+
+    def fix_morphology(self, page):
+        labels = self.needs_fixing()
+        if not self.shape_props or len(labels) == 0:
+            return
+        # Activate cells in order of their top row, each cell's bounding box is reassembled from the bands it spans
+        order = labels[np.argsort(self.min_row[labels], kind='stable')]
+        start, stop = int(self.min_row[order[0]]), int(self.max_row[labels].max())
+        crops = {}
+        next_cell = 0
+        for top, band in iter_row_bands(page, BAND_HEIGHT, start=start, stop=stop):
+            bottom = top + band.shape[0]
+            while next_cell < len(order) and self.min_row[order[next_cell]] < bottom:
+                l = order[next_cell]
+                crops[l] = np.zeros((self.max_row[l] - self.min_row[l], self.max_col[l] - self.min_col[l]), dtype=np.uint8)
+                next_cell += 1
+            for l in list(crops):
+                r0, r1, c0, c1 = self.min_row[l], self.max_row[l], self.min_col[l], self.max_col[l]
+                lo, hi = max(r0, top), min(r1, bottom)
+                crops[l][lo - r0:hi - r0] = band[lo - top:hi - top, c0:c1] == l
+                if r1 <= bottom:
+                    # The bounding box is complete, so the shape properties are the same as for the full slide
+                    props = regionprops_table(crops.pop(l), properties=list(self.shape_props))
+                    for p in self.shape_props:
+                        self.shape_props[p][l] = props[p][0]
+
+    def to_frame(self):
+        # Region properties in the same layout as regionprops_table (one row per label, in ascending label order)
+        labels = np.nonzero(self.count)[0]
+        count = self.count[labels]
+        frame = {
+            'label': labels,
+            'area': count.astype(self.area_dtype),
+            'centroid-0': self.sum_row[labels] / count,
+            'centroid-1': self.sum_col[labels] / count,
+        }
+        for p in self.shape_props:
+            frame[p] = self.shape_props[p][labels]
+        signal = self.channel_sums[labels] / count.astype(np.float64)[:, None]
+        return pd.DataFrame(frame), signal
+
+
+def accumulate_slide(mask_file, channel_files, morphology):
+    # Streams the mask and every channel band by band, returns the region properties and mean intensities of every cell
+    accumulator = LabelAccumulator(len(channel_files), morphology=morphology)
+    with ExitStack() as stack:
+        mask_tiff = stack.enter_context(tifffile.TiffFile(stack.enter_context(local_tiff_path(mask_file))))
+        mask_page = mask_tiff.pages[0]
+        channel_pages = []
+        for channel in channel_files:
+            channel_tiff = stack.enter_context(tifffile.TiffFile(stack.enter_context(local_tiff_path(channel))))
+            assert channel_tiff.pages[0].shape == mask_page.shape, 'The protein channels and the segmentation mask are not the same dimension'
+            channel_pages.append(channel_tiff.pages[0])
+
+        for top, band in iter_row_bands(mask_page, BAND_HEIGHT):
+            band = band.astype(np.int64)
+            accumulator.add_mask_band(top, band, is_last_band=top + band.shape[0] >= mask_page.imagelength)
+            # One channel band in memory at a time
+            for c, page in enumerate(channel_pages):
+                channel_band = read_region(page, top, 0, band.shape[0], page.imagewidth)
+                accumulator.add_channel_band(band, channel_band, c)
+
+        accumulator.fix_morphology(mask_page)
+
+    return accumulator.to_frame()
+
+
+def extract_membrane_for_slide(membrane_mask, channels, core_name, channels_to_include):
+    props, signal = accumulate_slide(membrane_mask, channels, morphology=True)
+    return to_tabular_format.membrane_table(props, signal, core_name, channels_to_include)
+
+
+def extract_nucleus_for_slide(nucleus_mask, channels, core_name, channels_to_include):
+    props, signal = accumulate_slide(nucleus_mask, channels, morphology=False)
+    return to_tabular_format.nucleus_table(props, signal, core_name, channels_to_include)
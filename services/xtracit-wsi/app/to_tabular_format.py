@@ -8,7 +8,7 @@ COLUMN_NAMES = ['Cell_ID','Region','x','y','Size','Perimeter','MajorAxisLength',
     
 REGION_PROPERTIES = ['area','centroid', 'perimeter',  
                       'major_axis_length','minor_axis_length', 'eccentricity', 'solidity', 
-                      'orientation','equivalent_diameter','coords','label']
+                      'orientation','equivalent_diameter','label']
 
 # regionprops_table For Mapping from REGION_PROPERTIES to  COLUMN_NAMES
 COL_REGION_MAP = {
@@ -23,7 +23,7 @@ COL_REGION_MAP = {
 }
 
 NUC_COLUMN_NAMES = ['Cell_ID','nucleus_Region','nucleus_x','nucleus_y','nucleus_Size']
-NUCLEUS_PROPERTIES = ['area','centroid','label','coords']
+NUCLEUS_PROPERTIES = ['area','centroid','label']
 
 NUC_COL_REGION_MAP = {
     'nucleus_x' : 'centroid-1',
@@ -31,20 +31,31 @@ NUC_COL_REGION_MAP = {
     'nucleus_Size' : 'area',
 }
 
-# Function for leverage pandas vectorization
-# For each row, it iterates of the list of coordinates, gets the means intensity for all the protein channels 
-def get_protein_signal_for_cells(coords, area, channel_stack):
-    all_signal_counts_for_cell = []
-    for coord in coords:
-        col, row = coord
-        all_signal_counts_for_cell.append(channel_stack[col, row,:])
-        
-    return np.sum(all_signal_counts_for_cell,axis=0) / area
+# Mean intensity of every channel for every cell, computed with label-indexed reductions
+# One bincount over the label image per channel replaces iterating over the pixel coordinates of each cell
+def get_protein_signal_for_cells(label_image, labels, area, channel_stack):
+    flat_labels = label_image.ravel()
+    # Bins are indexed by label, so size them to the largest label present in the mask
+    n_bins = int(flat_labels.max()) + 1 if flat_labels.size else 1
+    signal = np.empty((len(labels), channel_stack.shape[2]), dtype=np.float64)
+    for c in range(channel_stack.shape[2]):
+        # Summing in float64 is exact for integer pixel values, so the means match summing the pixels one by one
+        sums = np.bincount(flat_labels, weights=channel_stack[..., c].ravel(), minlength=n_bins)
+        signal[:, c] = sums[labels]
+
+    return signal / np.asarray(area, dtype=np.float64)[:, None]
 
 def extract_membrane_for_core(membrane_mask,channel_stack,core_name,channels_to_include):
     # Using the mask, find the coordinates of all the cells, and the locations of the pixels within those cells
-    extractedDataMemTab = pd.DataFrame(regionprops_table(membrane_mask.astype(int), properties=REGION_PROPERTIES))
-    
+    membrane_mask = membrane_mask.astype(int)
+    extractedDataMemTab = pd.DataFrame(regionprops_table(membrane_mask, properties=REGION_PROPERTIES))
+    # Extracts the signal intensities for all cells
+    signal = get_protein_signal_for_cells(membrane_mask, extractedDataMemTab['label'].to_numpy(), extractedDataMemTab['area'].to_numpy(), channel_stack)
+
+    return membrane_table(extractedDataMemTab, signal, core_name, channels_to_include)
+
+# Builds the membrane dataframe from the region properties of the cells and their per channel mean intensities
+def membrane_table(extractedDataMemTab, signal, core_name, channels_to_include):
     # The is creating the template of the final dataframe
     df = pd.DataFrame(index=np.arange(extractedDataMemTab.shape[0]), columns=COLUMN_NAMES)
     # In the final dataframe, copy over the cell ids (adjust to start from 1) + copy in the core name number (again starting counting from 1) 
@@ -60,17 +71,22 @@ def extract_membrane_for_core(membrane_mask,channel_stack,core_name,channels_to_
     df['PerimeterSquareToArea'] = np.square(df['Perimeter']) / df['Size']
     df['MajorAxisToEquivalentDiam'] = df['MajorAxisLength'] / extractedDataMemTab['equivalent_diameter']
     
-    # Create a dataframe for the storing the outcoming of the extraction of the signals
-    cell_signal_df = pd.DataFrame()
-    # Extracts the signal intensities for all cells and stores it in a dataframe
-    cell_signal_df[channels_to_include] = extractedDataMemTab.apply(lambda x: get_protein_signal_for_cells(x.coords, x.area,channel_stack), axis=1).apply(pd.Series)
+    # Stores the signal intensities for all cells in a dataframe
+    cell_signal_df = pd.DataFrame(signal, columns=channels_to_include)
     
     return pd.concat([df,cell_signal_df],axis=1,join='inner')
 
 def extract_nucelus_for_core(nucleus_mask,channel_stack,core_name,channels_to_include):
     # Using the mask, find the coordinates of all the cells, and the locations of the pixels within those cells
-    extractedDataNucTab = pd.DataFrame(regionprops_table(nucleus_mask.astype(int), properties=NUCLEUS_PROPERTIES))
-    
+    nucleus_mask = nucleus_mask.astype(int)
+    extractedDataNucTab = pd.DataFrame(regionprops_table(nucleus_mask, properties=NUCLEUS_PROPERTIES))
+    # Extracts the signal intensities for all cells
+    signal = get_protein_signal_for_cells(nucleus_mask, extractedDataNucTab['label'].to_numpy(), extractedDataNucTab['area'].to_numpy(), channel_stack)
+
+    return nucleus_table(extractedDataNucTab, signal, core_name, channels_to_include)
+
+# Builds the nucleus dataframe from the region properties of the nuclei and their per channel mean intensities
+def nucleus_table(extractedDataNucTab, signal, core_name, channels_to_include):
     # The is creating the template of the final dataframe
     df = pd.DataFrame(index=np.arange(extractedDataNucTab.shape[0]), columns=NUC_COLUMN_NAMES)
     # In the final dataframe, copy over the cell ids (adjust to start from 1) + copy in the core name number (again starting counting from 1) 
@@ -83,10 +99,8 @@ def extract_nucelus_for_core(nucleus_mask,channel_stack,core_name,channels_to_in
     
 
     
-    # Create a dataframe for the storing the outcoming of the extraction of the signals
-    cell_signal_df = pd.DataFrame()
-    # Extracts the signal intensities for all cells and stores it in a dataframe
-    cell_signal_df[channels_to_include] = extractedDataNucTab.apply(lambda x: get_protein_signal_for_cells(x.coords, x.area,channel_stack), axis=1).apply(pd.Series)
+    # Stores the signal intensities for all cells in a dataframe
+    cell_signal_df = pd.DataFrame(signal, columns=channels_to_include)
     
     return pd.concat([df,cell_signal_df],axis=1,join='inner')
     
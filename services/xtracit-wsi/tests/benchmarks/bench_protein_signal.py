@@ -0,0 +1,72 @@
+# Benchmark for the per-cell protein signal extraction in to_tabular_format
+# Compares the original per-pixel implementation against the label-indexed reductions
+# and checks the two produce numerically identical tables on synthetic masks
+#
+# Run from the service root: python tests/benchmarks/bench_protein_signal.py [image_size] [n_channels]
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from skimage.measure import label, regionprops_table
+from skimage.morphology import disk, dilation
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / 'app'))
+import to_tabular_format #type: ignore
+
+
+# The original implementation, kept here as the reference the new engine is checked against
+def legacy_get_protein_signal_for_cells(coords, area, channel_stack):
+    all_signal_counts_for_cell = []
+    for coord in coords:
+        col, row = coord
+        all_signal_counts_for_cell.append(channel_stack[col, row,:])
+
+    return np.sum(all_signal_counts_for_cell,axis=0) / area
+
+def legacy_signal_table(props, channel_stack, channels):
+    cell_signal_df = pd.DataFrame()
+    cell_signal_df[channels] = props.apply(lambda x: legacy_get_protein_signal_for_cells(x.coords, x.area, channel_stack), axis=1).apply(pd.Series)
+    return cell_signal_df
+
+def synthetic_mask(size, n_cells, rng):
+    # Scatter seeds and grow them into touching blob shaped cells
+    seeds = np.zeros((size, size), dtype=bool)
+    seeds[rng.integers(0, size, n_cells), rng.integers(0, size, n_cells)] = True
+    mask = label(seeds)
+    return dilation(mask, disk(3))
+
+
+if __name__ == '__main__':
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    n_channels = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    rng = np.random.default_rng(0)
+
+    mask = synthetic_mask(size, size * size // 200, rng)
+    channel_stack = rng.integers(0, 256, (size, size, n_channels), dtype=np.uint8)
+    channels = [f'C{i}' for i in range(n_channels)]
+    print(f'{size}x{size} image, {n_channels} channels, {len(np.unique(mask)) - 1} cells')
+
+    # regionprops is shared by both paths, so only the signal extraction itself is timed
+    props = pd.DataFrame(regionprops_table(mask.astype(int), properties=['area','coords','label']))
+
+    start = time.perf_counter()
+    legacy = legacy_signal_table(props, channel_stack, channels)
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    signal = to_tabular_format.get_protein_signal_for_cells(mask.astype(int), props['label'].to_numpy(), props['area'].to_numpy(), channel_stack)
+    new_time = time.perf_counter() - start
+
+    np.testing.assert_array_equal(signal, legacy.to_numpy(dtype=np.float64))
+
+    # Both extractors must return exactly the signal the original implementation produced
+    membrane_df = to_tabular_format.extract_membrane_for_core(mask, channel_stack, 'A0', channels)
+    nucleus_df = to_tabular_format.extract_nucelus_for_core(mask, channel_stack, 'A0', channels)
+    np.testing.assert_array_equal(membrane_df[channels].to_numpy(dtype=np.float64), legacy.to_numpy(dtype=np.float64))
+    np.testing.assert_array_equal(nucleus_df[channels].to_numpy(dtype=np.float64), legacy.to_numpy(dtype=np.float64))
+
+    print(f'per-pixel signal extraction:     {legacy_time:.3f}s')
+    print(f'label-indexed signal extraction: {new_time:.3f}s ({legacy_time / new_time:.1f}x)')
+    print('outputs identical')